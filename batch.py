@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from report_builder import ReportBuilder
+from image_cache import ImageCache
+from instrumentation import PrometheusTextfile, instrumented_job
+from template_cache import compile_template
+from dotenv import load_dotenv
+import argparse
+import csv
+import json
+import os
+import traceback
+
+
+CORE_PROPERTY_NAMES = ["title", "author", "subject", "keywords"]
+
+# Template of the worker process, compiled by init_worker() and recompiled when it changes
+_template_path = None
+_image_cache = None
+
+
+def load_manifest(manifest_path):
+    """
+    Load report jobs from a CSV, JSON or JSONL manifest.
+
+    JSON and JSONL jobs look like:
+        {"output": "...", "core_properties": {...}, "custom_properties": {...}, "images": [...]}
+    CSV rows have an "output" column, an "images" column with paths separated
+    by ";", the core property columns (title, author, subject, keywords), and
+    every other column is used as a custom property. Blank cells are left
+    out, so their placeholders stay visible in the report.
+
+    Relative output and image paths are resolved against the manifest folder.
+    """
+    extension = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            jobs = [job_from_csv_row(row) for row in csv.DictReader(f)]
+        elif extension == '.jsonl':
+            jobs = [json.loads(line) for line in f if line.strip()]
+        elif extension == '.json':
+            jobs = json.load(f)
+            if isinstance(jobs, dict):
+                jobs = jobs["jobs"]
+        else:
+            raise ValueError(f"Unsupported manifest format '{extension}', expected .csv, .json or .jsonl")
+
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    for job in jobs:
+        job["output"] = os.path.join(base_folder, job["output"])
+        job["images"] = [os.path.join(base_folder, image) for image in job.get("images", [])]
+        job.setdefault("core_properties", {})
+        job.setdefault("custom_properties", {})
+    return jobs
+
+
+def job_from_csv_row(row):
+    job = {"output": row.pop("output"), "core_properties": {}, "custom_properties": {}}
+    job["images"] = [image.strip() for image in row.pop("images", "").split(";") if image.strip()]
+    for name, value in row.items():
+        # As in pipeline.report_inputs
+        if not value:
+            continue
+        if name in CORE_PROPERTY_NAMES:
+            job["core_properties"][name] = value
+        else:
+            job["custom_properties"][name] = value
+    return job
+
+
+def init_worker(template_file_path, image_cache_folder=None):
+    global _template_path, _image_cache
+    _template_path = template_file_path
+    compile_template(template_file_path)
+    _image_cache = ImageCache(image_cache_folder) if image_cache_folder else None
+
+
+def run_job(job):
+    """
+    Build one report from a fresh copy of the worker's compiled template.
+
+    The template is compiled again if its file changed since the last job.
+
+    A job with "update" set patches the report built for it earlier instead
+    (see ReportBuilder.update). The job is instrumented (see
+    instrumentation.instrumented_job) and its summary returned, whether it
+    succeeded or not.
+    """
+    instrumentation = None
+    try:
+        builder = ReportBuilder(
+            compile_template(_template_path),
+            job["output"],
+            job["core_properties"],
+            job["custom_properties"],
+            job["images"],
+            # Jobs already run in parallel, so resize images in the worker itself
+            image_workers=1,
+            image_cache=_image_cache,
+        )
+        with instrumented_job(os.path.basename(job["output"])) as instrumentation:
+            if job.get("update"):
+                builder.update()
+            else:
+                builder.build()
+        return {"output": job["output"], "ok": True, "timings": builder.timings,
+                "counters": dict(instrumentation.counters), "instrumentation": instrumentation.to_dict()}
+    except Exception as e:
+        return {"output": job["output"], "ok": False, "error": f"{type(e).__name__}: {e}",
+                "traceback": traceback.format_exc(),
+                "instrumentation": instrumentation.to_dict() if instrumentation is not None else None}
+
+
+def run_batch(template_file_path, jobs, workers=None, image_cache_folder=None, metrics_textfile=None):
+    """
+    Generate every job over a process pool and return one result per job.
+
+    With `metrics_textfile`, the workers' job summaries are totalled in that
+    Prometheus textfile as the jobs finish.
+    """
+    textfile = PrometheusTextfile(metrics_textfile) if metrics_textfile else None
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(template_file_path, image_cache_folder)) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. BrokenProcessPool)
+                result = {"output": futures[future]["output"], "ok": False, "error": f"{type(e).__name__}: {e}"}
+
+            if textfile is not None:
+                textfile.record_and_write(result.get("instrumentation"))
+            if result["ok"]:
+                print(f"OK     {result['output']}")
+            else:
+                print(f"FAILED {result['output']}: {result['error']}")
+            results.append(result)
+
+    failed = sum(1 for result in results if not result["ok"])
+    print(f"{len(results) - failed} of {len(results)} reports generated, {failed} failed")
+    return results
+
+
+if __name__ == "__main__":
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description="Generate one report per job in a manifest.")
+    parser.add_argument("manifest", help="CSV, JSON or JSONL file describing the jobs")
+    parser.add_argument("--template", default=os.getenv('TEMPLATE_DOC_PATH'), help="Word template (default: TEMPLATE_DOC_PATH)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--image-cache", default=os.getenv('IMAGE_CACHE_DIR') or None,
+                        help="folder of processed images shared between runs (default: IMAGE_CACHE_DIR)")
+    parser.add_argument("--metrics-textfile", default=os.getenv('PROMETHEUS_TEXTFILE') or None,
+                        help="Prometheus textfile to keep job totals in (default: PROMETHEUS_TEXTFILE)")
+    args = parser.parse_args()
+
+    results = run_batch(args.template, load_manifest(args.manifest), args.workers, args.image_cache,
+                        args.metrics_textfile)
+    if not all(result["ok"] for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,264 @@
+from docx.shared import Inches
+from docx.oxml.ns import qn
+from instrumentation import max_rss_bytes
+from PIL import Image, ImageDraw
+from report_builder import ReportBuilder
+from sinks import MemorySink
+from template_cache import compile_template
+from utils import ImageRecord, replace_text_in_table
+from wordextraction import open_document, extract_records
+import argparse
+import copy
+import datetime
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+
+# Bump when the layout of the results changes
+RESULTS_VERSION = 1
+
+BASE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SEED_TEMPLATE = os.path.join(BASE_FOLDER, "Template Report", "Sample Report - Copy.docx")
+SEED_INPUT = os.path.join(BASE_FOLDER, "ReportInputsTemplate.docm")
+SEED_IMAGES = os.path.join(BASE_FOLDER, "Images")
+
+
+def make_photos(folder, count, size, seed_folder=SEED_IMAGES):
+    """
+    Write `count` distinct JPEG photos of `size` (width, height) to `folder`.
+
+    The photos are the seed images resized, each with a differently placed
+    block so that content-hash deduplication can't skip any of them.
+    """
+    os.makedirs(folder, exist_ok=True)
+    seeds = []
+    for path in sorted(glob.glob(os.path.join(seed_folder, "*"))):
+        with Image.open(path) as seed:
+            seeds.append(seed.convert("RGB").resize(size))
+
+    paths = []
+    for i in range(count):
+        photo = seeds[i % len(seeds)].copy()
+        x = (i * 37) % max(size[0] - 20, 1)
+        y = (i * 53) % max(size[1] - 20, 1)
+        ImageDraw.Draw(photo).rectangle([x, y, x + 20, y + 20], fill=(i * 7 % 256, i * 13 % 256, i * 29 % 256))
+        path = os.path.join(folder, f"photo_{i + 1:04}.jpg")
+        photo.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def make_template(path, placeholders, tables, seed_path=SEED_TEMPLATE):
+    """
+    Write a copy of the seed template with `placeholders` extra placeholders.
+
+    Half of the placeholders go in body paragraphs and the rest in the cells
+    of `tables` extra two-column tables. Returns the custom properties that
+    fill them in.
+    """
+    doc = open_document(seed_path)
+    keys = [f"synthetic placeholder {i + 1}" for i in range(placeholders)]
+
+    in_paragraphs = keys[:len(keys) // 2] if tables else keys
+    in_tables = keys[len(in_paragraphs):]
+    for key in in_paragraphs:
+        doc.add_paragraph(f"Value of {key}: {key}.")
+
+    for t in range(tables):
+        # Spread the remaining placeholders over the tables, at least one row each
+        table_keys = in_tables[t::tables]
+        table = doc.add_table(rows=max(len(table_keys), 1), cols=2)
+        for row, key in zip(table.rows, table_keys):
+            row.cells[0].text = key.capitalize() + ":"
+            row.cells[1].text = key
+        doc.add_paragraph()
+
+    doc.save(path)
+    return {key: f"value {i + 1}" for i, key in enumerate(keys)}
+
+
+def make_input_document(path, photos, seed_path=SEED_INPUT):
+    """Write a copy of the seed input form with one picture row per photo."""
+    doc = open_document(seed_path)
+    picture_table = doc.tables[-1]
+    rows = picture_table._tbl.tr_lst
+    # Rows beyond the seed's are copies of its last, empty one
+    while len(rows) - 1 < len(photos):
+        picture_table._tbl.append(copy.deepcopy(rows[-1]))
+        rows = picture_table._tbl.tr_lst
+
+    for i, (row, photo) in enumerate(zip(picture_table.rows[1:], photos), start=1):
+        cells = row.cells
+        cells[0].text = str(i)
+        cells[1].text = f"Figure shows synthetic photo {i}"
+        cells[2].text = f"Synthetic photo {i}"
+        cells[3].text = ""
+        cells[3].paragraphs[0].add_run().add_picture(photo, width=Inches(2))
+        # The extractor names pictures after their alt text
+        cells[3]._tc.findall('.//' + qn('wp:docPr'))[-1].set('descr', os.path.basename(photo))
+
+    doc.save(path)
+
+
+class StageResults:
+    """Run times and peak traced memory of named stages."""
+
+    def __init__(self):
+        self.runs = {}
+        self.peaks = {}
+
+    def time(self, name, function):
+        start = time.perf_counter()
+        result = function()
+        self.runs.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def trace(self, name, function):
+        # Peak Python allocations while `function` runs, above what was allocated before
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        self.peaks[name] = max(self.peaks.get(name, 0), tracemalloc.get_traced_memory()[1] - before)
+        return result
+
+    def to_dict(self):
+        return {
+            name: {
+                "runs": runs,
+                "min": min(runs),
+                "median": statistics.median(runs),
+                "peak_bytes": self.peaks.get(name),
+            }
+            for name, runs in self.runs.items()
+        }
+
+
+def run_once(results, measure, template, output_path, custom_properties, photos, input_path, options):
+    """Run every benchmarked stage once, through `measure` (results.time or results.trace)."""
+    measure("template load", lambda: open_document(template if isinstance(template, str) else template.path))
+
+    doc = open_document(template if isinstance(template, str) else template.path)
+    keys, values = list(custom_properties), list(custom_properties.values())
+    measure("replace_text_in_table", lambda: [replace_text_in_table(table, keys, values) for table in doc.tables])
+
+    images = [ImageRecord(photo, f"shows synthetic photo {i}", f"Synthetic photo {i}")
+              for i, photo in enumerate(photos, start=1)]
+    builder = ReportBuilder(template, output_path, {"title": "Benchmark"}, custom_properties, images, **options)
+    for name, stage in builder.stages():
+        measure("build: " + name, stage)
+
+    measure("extraction (streaming)", lambda: extract_records(input_path, MemorySink(), streaming=True))
+    measure("extraction (python-docx)", lambda: extract_records(input_path, MemorySink(), streaming=False))
+
+
+def run_benchmark(placeholders=10, tables=5, photos=20, photo_size=(2000, 1500), repeat=3, compiled=False,
+                  work_folder=None, **builder_options):
+    """
+    Generate synthetic inputs and time every stage `repeat` times.
+
+    Timed runs are made without tracing; one more run under tracemalloc
+    gives each stage's peak memory. Work done in other processes, such as
+    image preprocessing with several workers, is timed but not traced.
+    """
+    work_folder = work_folder or tempfile.mkdtemp(prefix="report-benchmark-")
+    os.makedirs(work_folder, exist_ok=True)
+    print(f"Generating inputs in {work_folder}")
+    photo_paths = make_photos(os.path.join(work_folder, "photos"), photos, photo_size)
+    template_path = os.path.join(work_folder, "template.docx")
+    custom_properties = make_template(template_path, placeholders, tables)
+    input_path = os.path.join(work_folder, "inputs.docm")
+    make_input_document(input_path, photo_paths)
+    output_path = os.path.join(work_folder, "report.docx")
+
+    template = compile_template(template_path, placeholders=custom_properties) if compiled else template_path
+    options = {"image_workers": 1}
+    options.update(builder_options)
+
+    results = StageResults()
+    for i in range(repeat):
+        print(f"Run {i + 1} of {repeat}")
+        run_once(results, results.time, template, output_path, custom_properties, photo_paths, input_path, options)
+
+    print("Memory run")
+    tracemalloc.start()
+    try:
+        run_once(results, results.trace, template, output_path, custom_properties, photo_paths, input_path, options)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "placeholders": placeholders,
+            "tables": tables,
+            "photos": photos,
+            "photo_size": list(photo_size),
+            "repeat": repeat,
+            "compiled": compiled,
+            "builder_options": options,
+        },
+        "stages": results.to_dict(),
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_FOLDER, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    """Print the median time and peak memory of each stage, against `baseline` results if given."""
+    base_stages = baseline["stages"] if baseline else {}
+    for name, stage in results["stages"].items():
+        line = f"{name:<40}{stage['median'] * 1000:>10.1f} ms"
+        if stage["peak_bytes"] is not None:
+            line += f"{stage['peak_bytes'] / 1024 / 1024:>10.1f} MB"
+        if name in base_stages and base_stages[name]["median"]:
+            line += f"{stage['median'] / base_stages[name]['median'] - 1:>+10.1%}"
+        print(line)
+    if baseline:
+        print(f"Compared with {baseline.get('commit')} ({baseline.get('created')})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the report stages on synthetic templates and photo sets.")
+    parser.add_argument("--placeholders", type=int, default=10, help="extra placeholders in the template")
+    parser.add_argument("--tables", type=int, default=5, help="extra tables holding placeholders in the template")
+    parser.add_argument("--photos", type=int, default=20, help="number of photos")
+    parser.add_argument("--photo-size", default="2000x1500", help="photo size in pixels, WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each stage")
+    parser.add_argument("--compiled", action="store_true", help="build from a compiled template")
+    parser.add_argument("--image-workers", type=int, default=1, help="image preprocessing processes")
+    parser.add_argument("--work-folder", help="where to write the generated inputs (default: a temporary folder)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    width, height = (int(n) for n in args.photo_size.lower().split("x"))
+    results = run_benchmark(args.placeholders, args.tables, args.photos, (width, height), args.repeat,
+                            args.compiled, args.work_folder, image_workers=args.image_workers)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
@@ -0,0 +1,90 @@
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.part import XmlPart
+from docx.opc.pkgwriter import _ContentTypesItem
+from image_parts import FileImagePart
+from instrumentation import timed
+from utils import CHUNK_SIZE, atomic_write
+from lxml import etree
+import shutil
+import zipfile
+
+
+# Content types that are compressed already and are stored as they are
+STORED_CONTENT_TYPE_PREFIXES = ("image/", "audio/", "video/")
+# Except these image formats, which deflate well
+DEFLATED_IMAGE_TYPES = {"image/bmp", "image/tiff", "image/x-emf", "image/x-wmf", "image/svg+xml"}
+
+
+def compression_for(content_type):
+    if content_type.startswith(STORED_CONTENT_TYPE_PREFIXES) and content_type not in DEFLATED_IMAGE_TYPES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def iter_package_parts(package):
+    # The same depth-first walk of the relationships as python-docx's, but
+    # with a set of visited parts, which keeps it linear in the part count
+    visited = set()
+    stack = [iter(package.rels.values())]
+    while stack:
+        rel = next(stack[-1], None)
+        if rel is None:
+            stack.pop()
+            continue
+        if rel.is_external or id(rel.target_part) in visited:
+            continue
+        part = rel.target_part
+        visited.add(id(part))
+        yield part
+        stack.append(iter(part.rels.values()))
+
+
+@timed()
+def save_document(doc, path, xml_compress_level=6):
+    """
+    Save `doc` to `path`, an alternative to doc.save() for large reports.
+
+    Images are stored without compression, as deflating a JPEG costs time
+    and saves nothing, while XML parts are deflated at `xml_compress_level`
+    (1 is fastest, 9 smallest). Each part is streamed into the zip as it is
+    serialized. The package is written to a temporary file beside `path`
+    and renamed over it once complete, so `path` never holds a partly
+    written report.
+    """
+    package = doc.part.package
+    parts = list(iter_package_parts(package))
+    for part in parts:
+        part.before_marshal()
+
+    with atomic_write(path, fsync=True) as f:
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED, compresslevel=xml_compress_level) as package_zip:
+            package_zip.writestr(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob)
+            package_zip.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+            for part in parts:
+                write_part(package_zip, part)
+                if len(part.rels):
+                    package_zip.writestr(part.partname.rels_uri.membername, part.rels.xml)
+
+
+def write_part(package_zip, part):
+    name = part.partname.membername
+    if compression_for(part.content_type) == zipfile.ZIP_STORED:
+        member = zipfile.ZipInfo(name)
+        member.compress_type = zipfile.ZIP_STORED
+    else:
+        # A name gets the archive's compression and level
+        member = name
+
+    with package_zip.open(member, 'w') as target:
+        if isinstance(part, XmlPart):
+            # Serialize straight into the zip rather than to bytes first
+            etree.ElementTree(part.element).write(target, encoding='UTF-8', xml_declaration=True,
+                                                  standalone=True)
+        elif isinstance(part, FileImagePart):
+            # Copied from its file a chunk at a time, never held in memory whole
+            with part.open() as source:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+        else:
+            blob = memoryview(part.blob)
+            for start in range(0, len(blob), CHUNK_SIZE):
+                target.write(blob[start:start + CHUNK_SIZE])
@@ -0,0 +1,163 @@
+from utils import atomic_write
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+# Bump when process_image() changes so old entries are not reused
+CACHE_VERSION = 1
+
+# Subfolder of the builders' temporary image folders (see spill_folder)
+SPILL_FOLDER_NAME = 'spill'
+
+# Spill folders older than this were left by a run that crashed
+STALE_SPILL_SECONDS = 24 * 3600
+
+
+class ImageCache:
+    """
+    On-disk cache of processed images, shared between runs and processes.
+
+    Entries are keyed by the hash of the source file plus the processing
+    parameters, and hold the ready-to-embed bytes (`<key>.img`) and their
+    pixel dimensions (`<key>.json`). Files are written to a temporary name
+    and renamed into place, so readers never see a partial entry. Reading an
+    entry refreshes its modification time, and the least recently used
+    entries are evicted once the cache grows past `max_bytes`.
+
+    Builders keep their processed images in temporary folders under
+    `spill/`, on the same file system, so cache hits can be hard-linked
+    into them. Folders left there by a crashed run are removed by evict().
+    """
+
+    def __init__(self, folder, max_bytes=1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_since_evict = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, source_hash, max_width_px, dpi, quality):
+        params = f"{CACHE_VERSION}:{source_hash}:{max_width_px}:{dpi}:{quality}"
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def get(self, key):
+        """Return (bytes, width, height) for `key`, or None on a miss."""
+        data_path = os.path.join(self.folder, key + '.img')
+        try:
+            with open(os.path.join(self.folder, key + '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            os.utime(data_path)
+        except (FileNotFoundError, ValueError):
+            # Missing, evicted by another process meanwhile, or half-written metadata
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data, meta["width"], meta["height"]
+
+    def link(self, key, target):
+        """
+        Make `target` a copy of the image of `key` without reading it into memory.
+
+        Returns (width, height), or None on a miss. A hard link is used where
+        the file system allows it, so evicting the entry later doesn't affect
+        `target`.
+        """
+        data_path = os.path.join(self.folder, key + '.img')
+        try:
+            with open(os.path.join(self.folder, key + '.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            try:
+                os.link(data_path, target)
+            except FileExistsError:
+                # Linked or written by an earlier call for the same image
+                pass
+            except FileNotFoundError:
+                raise
+            except OSError:
+                shutil.copyfile(data_path, target)
+            os.utime(data_path)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta["width"], meta["height"]
+
+    def spill_folder(self):
+        """Return a new TemporaryDirectory for a builder's processed images, beside the entries."""
+        folder = os.path.join(self.folder, SPILL_FOLDER_NAME)
+        os.makedirs(folder, exist_ok=True)
+        return tempfile.TemporaryDirectory(prefix="report-images-", dir=folder)
+
+    def put(self, key, data, width, height):
+        # Metadata first: an entry only counts once its .img file exists
+        self._write_atomic(key + '.json', json.dumps({"width": width, "height": height}).encode())
+        self._write_atomic(key + '.img', data)
+
+        # Scanning the folder is O(entries), so only do it every few percent of max_bytes
+        self.bytes_since_evict += len(data)
+        if self.bytes_since_evict >= self.max_bytes // 20:
+            self.evict()
+
+    def _write_atomic(self, name, data):
+        with atomic_write(os.path.join(self.folder, name)) as f:
+            f.write(data)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes, and stale spill folders."""
+        self.bytes_since_evict = 0
+        entries = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp') and now - stat.st_mtime > 3600:
+                    # Left behind by a writer that crashed
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                if not entry.name.endswith('.img'):
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+                total += stat.st_size
+
+        self.remove_stale_spill_folders(now)
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            for extension in ('.img', '.json'):
+                try:
+                    os.remove(os.path.join(self.folder, key + extension))
+                except FileNotFoundError:
+                    # Another process evicted it first
+                    pass
+            total -= size
+
+    def remove_stale_spill_folders(self, now):
+        folder = os.path.join(self.folder, SPILL_FOLDER_NAME)
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                stale = entry.is_dir() and now - entry.stat().st_mtime > STALE_SPILL_SECONDS
+            except FileNotFoundError:
+                continue
+            if stale:
+                shutil.rmtree(entry.path, ignore_errors=True)
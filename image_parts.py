@@ -0,0 +1,108 @@
+from docx.image.image import Image, _ImageHeaderFactory
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml.shape import CT_Inline
+from docx.parts.image import ImagePart
+from instrumentation import increment
+import hashlib
+import io
+import os
+
+
+class FileImage(Image):
+    """
+    An Image whose bytes stay in a file until they are asked for.
+
+    Only the path, the SHA-1 and the header (type, pixel size and dpi) are
+    kept in memory.
+    """
+
+    def __init__(self, path, sha1, filename, image_header):
+        super().__init__(None, filename, image_header)
+        self.path = path
+        self._sha1 = sha1
+
+    @classmethod
+    def from_path(cls, path, filename=None):
+        """
+        Read the header and hash of the image at `path`.
+
+        `filename` names the picture in the document; without it the picture
+        is named like one added from a stream, e.g. "image.jpeg".
+        """
+        # Imported here as utils imports this module
+        from utils import CHUNK_SIZE
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            image_header = _ImageHeaderFactory(f)
+            f.seek(0)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        if filename is None:
+            filename = "image.%s" % image_header.default_ext
+        return cls(path, sha1.hexdigest(), filename, image_header)
+
+    @property
+    def blob(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def sha1(self):
+        return self._sha1
+
+
+class FileImagePart(ImagePart):
+    """An image part that reads its bytes from a FileImage only when the package is saved."""
+
+    def __init__(self, partname, image):
+        super().__init__(partname, image.content_type, None, image)
+
+    @property
+    def blob(self):
+        return self._image.blob
+
+    @property
+    def sha1(self):
+        return self._image.sha1
+
+    def open(self):
+        return open(self._image.path, 'rb')
+
+
+def get_or_add_file_image_part(package, image):
+    """Return the package's image part with the bytes of FileImage `image`, adding one if needed."""
+    image_parts = package.image_parts
+    image_part = image_parts._get_by_sha1(image.sha1)
+    if image_part is None:
+        image_part = FileImagePart(image_parts._next_image_partname(image.ext), image)
+        image_parts.append(image_part)
+    return image_part
+
+
+def new_pic_inline(part, image, width=None, height=None):
+    """
+    Return a w:inline element showing ImageRecord `image`, for story part `part`.
+
+    Like part.new_pic_inline(), except that an image on disk (its processed
+    `data_path`, or else its original `path`) is added as a FileImagePart,
+    so its bytes are not held in memory until the document is saved.
+    """
+    increment("images embedded")
+    if image.data is not None:
+        increment("image bytes embedded", len(image.data))
+        return part.new_pic_inline(io.BytesIO(image.data), width, height)
+
+    if image.data_path is not None:
+        file_image = FileImage.from_path(image.data_path)
+    else:
+        file_image = FileImage.from_path(image.path, os.path.basename(image.path))
+    increment("image bytes embedded", os.path.getsize(file_image.path))
+    image_part = get_or_add_file_image_part(part.package, file_image)
+    rId = part.relate_to(image_part, RT.IMAGE)
+    cx, cy = image_part.image.scaled_dimensions(width, height)
+    return CT_Inline.new_pic_inline(part.next_id, rId, image_part.image.filename, cx, cy)
+
+
+def add_picture(run, image, width=None, height=None):
+    """Add the picture of ImageRecord `image` to the end of `run`."""
+    run._r.add_drawing(new_pic_inline(run.part, image, width, height))
@@ -0,0 +1,152 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+from utils import ImageRecord, file_hash, image_source
+import collections
+import hashlib
+import io
+import os
+
+
+def process_image(source, max_width_px, dpi, quality):
+    """
+    Downscale an image to `max_width_px` and re-encode it without metadata.
+
+    The EXIF orientation is applied to the pixels first, since the EXIF block
+    itself is not copied. Images with transparency stay PNG, everything else
+    becomes JPEG at `quality`. `source` is a path or the image bytes.
+    Returns (bytes, width, height).
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        img = ImageOps.exif_transpose(img)
+
+        if img.width > max_width_px:
+            height = max(1, round(img.height * max_width_px / img.width))
+            img = img.resize((max_width_px, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+            img.save(out, 'PNG', optimize=True, dpi=(dpi, dpi))
+        else:
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(out, 'JPEG', quality=quality, optimize=True, dpi=(dpi, dpi))
+        return out.getvalue(), img.width, img.height
+
+
+class PreprocessStats:
+    def __init__(self):
+        self.images = 0
+        self.duplicates = 0
+        self.cached = 0
+        self.original_bytes = 0
+        self.processed_bytes = 0
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - self.processed_bytes
+
+    def print_summary(self):
+        mb = 1024 * 1024
+        print(f"Preprocessed {self.images} images ({self.duplicates} duplicates, {self.cached} from cache): "
+              f"{self.original_bytes / mb:.1f} MB -> {self.processed_bytes / mb:.1f} MB, "
+              f"saved {self.bytes_saved / mb:.1f} MB")
+
+
+def preprocess_images(images, width, dpi=200, quality=85, workers=None, stats=None, cache=None,
+                      spill_folder=None):
+    """
+    Yield ImageRecords whose `data` is the image resized for `width` (a Length).
+
+    Images are hashed by content so each distinct image is processed once,
+    and duplicates get the same bytes (python-docx then stores them as a
+    single part). Resizing runs on a process pool with at most a few images
+    in flight per worker, so `images` is still consumed lazily. With
+    `workers=1` everything runs in the calling process.
+
+    With an ImageCache, images processed with the same parameters by an
+    earlier run are read from the cache instead of being processed again.
+
+    With a `spill_folder`, each processed image is written there and the
+    records carry its `data_path` instead of `data`, so memory use doesn't
+    grow with the number of images.
+    """
+    stats = stats if stats is not None else PreprocessStats()
+    max_width_px = round(width / 914400 * dpi)  # EMU per inch
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    window = workers * 2
+
+    # Results by content hash, shared by duplicates: (bytes or spilled path, width, height)
+    results = {}
+    pending = collections.deque()
+
+    def cache_key(digest):
+        return cache.key(digest, max_width_px, dpi, quality)
+
+    def spill_path(digest):
+        return os.path.join(spill_folder, digest + '.img')
+
+    def store(digest, result):
+        data, width_px, height_px = result
+        stats.processed_bytes += len(data)
+        if cache is not None:
+            cache.put(cache_key(digest), data, width_px, height_px)
+        if spill_folder is not None:
+            with open(spill_path(digest), 'wb') as f:
+                f.write(data)
+            result = (spill_path(digest), width_px, height_px)
+        results[digest] = result
+
+    def submit(image):
+        if isinstance(image, str):
+            image = ImageRecord(image)
+        # Images extracted in memory already carry their bytes
+        source = image_source(image)
+        if isinstance(source, bytes):
+            digest = hashlib.sha256(source).hexdigest()
+        else:
+            digest = file_hash(source)
+        if digest in results:
+            stats.duplicates += 1
+        else:
+            stats.original_bytes += len(source) if isinstance(source, bytes) else os.path.getsize(source)
+            if cache is not None and spill_folder is not None:
+                size = cache.link(cache_key(digest), spill_path(digest))
+                cached = (spill_path(digest),) + size if size is not None else None
+                if cached is not None:
+                    stats.processed_bytes += os.path.getsize(spill_path(digest))
+            else:
+                cached = cache.get(cache_key(digest)) if cache is not None else None
+                if cached is not None:
+                    stats.processed_bytes += len(cached[0])
+            if cached is not None:
+                results[digest] = cached
+                stats.cached += 1
+            elif executor is None:
+                store(digest, process_image(source, max_width_px, dpi, quality))
+            else:
+                results[digest] = executor.submit(process_image, source, max_width_px, dpi, quality)
+        pending.append((image, digest))
+
+    def finish():
+        image, digest = pending.popleft()
+        if not isinstance(results[digest], tuple):
+            store(digest, results[digest].result())
+        stats.images += 1
+        if spill_folder is not None:
+            return image._replace(data=None, data_path=results[digest][0])
+        return image._replace(data=results[digest][0])
+
+    try:
+        for image in images:
+            submit(image)
+            if len(pending) >= window:
+                yield finish()
+        while pending:
+            yield finish()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    stats.print_summary()
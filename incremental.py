@@ -0,0 +1,299 @@
+from docx.oxml.ns import qn
+from docx.shared import Inches
+from docx.table import _Cell, Table
+from image_parts import add_picture, new_pic_inline
+from template_cache import CompiledTemplate
+from utils import (BookmarkAllocator, atomic_write, caption_bookmarks, caption_style_id, caption_title, file_hash, image_source,
+                   image_width_for, insert_cross_reference, is_seq_field, make_bullet_paragraph, make_caption_paragraph,
+                   make_run, make_table_separator, new_image_table, set_font_formatting, set_paragraph_spacing)
+import copy
+import hashlib
+import json
+import os
+
+
+# Bump when the manifest layout changes so old reports are rebuilt
+MANIFEST_VERSION = 1
+
+# Builder options that shape the whole report; changing one means a rebuild
+LAYOUT_OPTIONS = ["header_text", "columns", "rows_per_table", "page_break", "preprocess", "image_dpi",
+                  "image_quality"]
+
+
+def manifest_path(report_path):
+    return report_path + '.manifest.json'
+
+
+def template_hash(template):
+    # A template passed as a parsed Document can't be identified, so its reports are always rebuilt
+    if isinstance(template, CompiledTemplate):
+        return template.index["sha256"]
+    if isinstance(template, str):
+        return file_hash(template)
+    return None
+
+
+def image_source_hash(image):
+    source = image_source(image)
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    return file_hash(source)
+
+
+def input_manifest(builder):
+    """Describe the inputs of `builder`, whose figures have been recorded."""
+    return {
+        "version": MANIFEST_VERSION,
+        "template": template_hash(builder.template),
+        "options": {name: getattr(builder, name) for name in LAYOUT_OPTIONS},
+        "core properties": builder.core_properties,
+        "custom properties": builder.custom_properties,
+        "figures": [{"source": image_source_hash(figure), "description": figure.description,
+                     "title": caption_title(figure)} for figure in builder.figures],
+    }
+
+
+def save_manifest(builder, bookmarks):
+    """
+    Write the manifest of the report `builder` just saved.
+
+    `bookmarks` are the names of the caption bookmarks of its figures, in
+    order; they are how update() finds each figure's caption and bullet.
+    """
+    manifest = input_manifest(builder)
+    for figure, bookmark in zip(manifest["figures"], bookmarks):
+        figure["bookmark"] = bookmark
+    stat = os.stat(builder.output_path)
+    manifest["report"] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": file_hash(builder.output_path)}
+
+    with atomic_write(manifest_path(builder.output_path), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest(report_path):
+    try:
+        with open(manifest_path(report_path), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class ReportRevision:
+    """
+    The changes from the inputs of an existing report to new inputs.
+
+    When the changes can't be patched into the report, `rebuild` says why.
+    Otherwise `titles`, `descriptions` and `pictures` list the positions of
+    the figures whose caption, bullet or image changed, and `appended` the
+    positions of new figures.
+    """
+
+    def __init__(self, report_path, old, new):
+        self.old = old
+        self.new = new
+        self.rebuild = None
+        self.core_properties = False
+        self.titles = []
+        self.descriptions = []
+        self.pictures = []
+        self.appended = []
+
+        if old is None:
+            self.rebuild = "no manifest"
+        elif old.get("version") != MANIFEST_VERSION:
+            self.rebuild = "manifest from another version"
+        elif not report_unchanged(report_path, old["report"]):
+            self.rebuild = "report changed since it was built"
+        elif new["template"] is None or old["template"] != new["template"]:
+            self.rebuild = "template changed"
+        elif old["options"] != new["options"]:
+            self.rebuild = "layout options changed"
+        elif old["custom properties"] != new["custom properties"]:
+            # Their placeholders were replaced in the report and can't be found again
+            self.rebuild = "custom properties changed"
+        elif not set(old["core properties"]) <= set(new["core properties"]):
+            self.rebuild = "core properties removed"
+        elif len(new["figures"]) < len(old["figures"]):
+            self.rebuild = "figures removed"
+        elif len(new["figures"]) > len(old["figures"]) and not old["figures"]:
+            self.rebuild = "first figures added"
+        else:
+            self.core_properties = old["core properties"] != new["core properties"]
+            for i, (before, after) in enumerate(zip(old["figures"], new["figures"])):
+                if before["title"] != after["title"]:
+                    self.titles.append(i)
+                if before["description"] != after["description"]:
+                    self.descriptions.append(i)
+                if before["source"] != after["source"]:
+                    self.pictures.append(i)
+            self.appended = list(range(len(old["figures"]), len(new["figures"])))
+
+    def is_empty(self):
+        return not (self.core_properties or self.titles or self.descriptions or self.pictures or self.appended)
+
+    def __str__(self):
+        if self.rebuild:
+            return f"rebuild ({self.rebuild})"
+        return (f"{len(self.titles)} captions, {len(self.descriptions)} bullets and {len(self.pictures)} pictures "
+                f"changed, {len(self.appended)} figures added"
+                + (", core properties changed" if self.core_properties else ""))
+
+
+def report_unchanged(report_path, recorded):
+    try:
+        stat = os.stat(report_path)
+    except FileNotFoundError:
+        return False
+    if stat.st_mtime == recorded["mtime"] and stat.st_size == recorded["size"]:
+        return True
+    return file_hash(report_path) == recorded["sha256"]
+
+
+def patch_report(doc, builder, revision, images, label="Figure"):
+    """
+    Apply `revision` to `doc`, the report built for the old inputs.
+
+    `images` maps the position of each changed or appended figure to its
+    record, ready to embed. Returns the caption bookmark names of all the
+    figures, or None when the report isn't laid out as its manifest says
+    (the caller then rebuilds it).
+    """
+    body = doc.element.body
+    bookmarks = [figure["bookmark"] for figure in revision.old["figures"]]
+
+    # Find every figure's caption and the bullet that refers to it
+    captions = {}
+    references = {}
+    seq_fields = 0
+    for element in body.iter(qn('w:bookmarkStart'), qn('w:instrText'), qn('w:fldSimple')):
+        if element.tag == qn('w:bookmarkStart'):
+            captions[element.get(qn('w:name'))] = element.getparent()
+        elif is_seq_field(element, label):
+            seq_fields += 1
+        elif element.tag == qn('w:instrText') and (element.text or "").split()[:1] == ["REF"]:
+            references[element.text.split()[1]] = next(element.iterancestors(qn('w:p')))
+
+    for bookmark in bookmarks:
+        if bookmark not in captions or bookmark not in references:
+            print(f"Figure bookmark {bookmark} is missing from the report.")
+            return None
+    # Appended figures continue the numbering, so no other figure may follow ours
+    if revision.appended and seq_fields != len(bookmarks):
+        print(f"The report has {label} captions that were not added by the report builder.")
+        return None
+
+    if revision.core_properties:
+        for name, value in revision.new["core properties"].items():
+            setattr(doc.core_properties, name, value)
+
+    for i in revision.titles:
+        set_caption_title(captions[bookmarks[i]], revision.new["figures"][i]["title"])
+
+    for i in revision.descriptions:
+        set_bullet_text(references[bookmarks[i]], revision.new["figures"][i]["description"] or "shows ")
+
+    for i in revision.pictures:
+        replace_picture(doc, captions[bookmarks[i]].getprevious(), images[i])
+
+    if revision.appended:
+        last_caption = captions[bookmarks[-1]]
+        appended = append_figures(doc, builder, last_caption, len(bookmarks) + 1,
+                                  [images[i] for i in revision.appended], label)
+        bookmarks.extend(appended)
+
+    return bookmarks
+
+
+def set_caption_title(caption, title):
+    # The title is everything after the bookmarked "Figure N"
+    bookmark_end = caption.find(qn('w:bookmarkEnd'))
+    for child in list(bookmark_end.itersiblings()):
+        caption.remove(child)
+    caption.append(make_run(". " + title))
+
+
+def set_bullet_text(bullet, text):
+    # The text is everything after the cross-reference field
+    field_end = [run for run in bullet.iterchildren(qn('w:r'))
+                 if run.find(qn('w:fldChar')) is not None
+                 and run.find(qn('w:fldChar')).get(qn('w:fldCharType')) == 'end'][-1]
+    for child in list(field_end.itersiblings()):
+        bullet.remove(child)
+    bullet.append(make_run(" " + text))
+    set_font_formatting(bullet)
+
+
+def replace_picture(doc, image_paragraph, image):
+    """Swap the picture in `image_paragraph` for `image`, at the same width."""
+    inline = image_paragraph.find('.//' + qn('wp:inline'))
+    rId = inline.find('.//' + qn('a:blip')).get(qn('r:embed'))
+    inline.getparent().replace(inline, new_pic_inline(doc.part, image, width=inline.extent.cx))
+
+    # Identical images share a part; it goes only when no other picture uses it
+    if not any(blip.get(qn('r:embed')) == rId for blip in doc.element.iter(qn('a:blip'))):
+        del doc.part.rels[rId]
+
+
+def append_figures(doc, builder, last_caption, number, images, label, table_width=Inches(7.4)):
+    """
+    Lay out `images` after the last figure, as a full build would have.
+
+    The last image table is filled up first, then new tables are started
+    every `rows_per_table` rows. Each image gets its caption, numbered from
+    `number`, and a cross-referenced bullet above its table. Returns the
+    names of the new caption bookmarks.
+    """
+    columns = builder.columns
+    column_width = table_width // columns
+    image_width = image_width_for(columns, table_width)
+    caption_style = caption_style_id(doc)
+    bullet_style = doc.styles['List Bullet 2'].style_id
+    bookmarks = BookmarkAllocator(doc)
+
+    tbl = next(last_caption.iterancestors(qn('w:tbl')))
+    table = Table(tbl, doc._body)
+    rows_in_table = len(tbl.tr_lst)
+    column = len(caption_bookmarks(tbl, label)) % columns
+    row_cells = tbl.tr_lst[-1].tc_lst
+
+    # The pre-formatted empty row of a scratch table, to extend the last table with
+    scratch, row_template = new_image_table(doc, columns, column_width)
+    scratch._element.getparent().remove(scratch._element)
+
+    names = []
+    for image in images:
+        if column == 0:
+            if builder.rows_per_table and rows_in_table >= builder.rows_per_table:
+                separator = make_table_separator(builder.page_break)
+                table._element.addnext(separator)
+                table, row_template = new_image_table(doc, columns, column_width)
+                separator.addnext(table._element)
+                tr = table._tbl.tr_lst[0]
+                rows_in_table = 0
+            else:
+                tr = copy.deepcopy(row_template)
+                table._tbl.append(tr)
+            rows_in_table += 1
+            row_cells = tr.tc_lst
+
+        paragraph = _Cell(row_cells[column], table).paragraphs[0]
+        add_picture(paragraph.add_run(), image, width=image_width)
+
+        caption = make_caption_paragraph(label, number, ". " + caption_title(image), caption_style, paragraph._p,
+                                         bookmarks)
+        paragraph._p.addnext(caption)
+        name = caption.find(qn('w:bookmarkStart')).get(qn('w:name'))
+
+        bullet = make_bullet_paragraph("", bullet_style)
+        table._element.addprevious(bullet)
+        insert_cross_reference(bullet, name, f"{label} {number}", image.description or "shows ")
+        set_font_formatting(bullet)
+        set_paragraph_spacing(bullet)
+
+        names.append(name)
+        number += 1
+        column = (column + 1) % columns
+
+    print(f"Appended {len(images)} figures")
+    return names
+
@@ -0,0 +1,351 @@
+from contextlib import contextmanager
+import collections
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import platform
+import re
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# The Instrumentation of the job running in this thread, if any
+_active = contextvars.ContextVar("instrumentation", default=None)
+
+# Lines of the tracemalloc dump, largest allocation sites first
+TRACEMALLOC_TOP = 50
+
+
+class StageTimer:
+    """The run time of one stage, in `seconds` once it has finished."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        # Peak traced Python memory while the stage ran, when tracing memory
+        self.peak_bytes = None
+
+    def to_dict(self):
+        return {"calls": self.calls, "seconds": self.seconds, "peak_bytes": self.peak_bytes}
+
+
+class Instrumentation:
+    """
+    Stage timings, counters and peak memory of one job.
+
+    While it is entered, stage(), timed() and increment() anywhere in the same
+    thread record into it. Nested stages are named by their path, e.g.
+    "image tables/add_image_tables", and a stage run several times adds up
+    its calls and time. With `trace_memory` each stage's peak traced memory
+    is recorded too, and with `profile` the job runs under cProfile; both
+    slow the job down, so they are meant to be switched on for one job at a
+    time while looking for a regression.
+    """
+
+    def __init__(self, job=None, trace_memory=False, profile=False):
+        self.job = job
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.status = None
+        self.started = None
+        self.seconds = None
+        self.peak_bytes = None
+        self.profiler = None
+        self.snapshot = None
+        # [path, peak traced bytes seen so far] of the open stages, the job itself first
+        self.stack = []
+        self._token = None
+        self._start = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        self._token = _active.set(self)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+        self.stack = [[None, 0]]
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory:
+            self.peak_bytes = max(self.stack[0][1], tracemalloc.get_traced_memory()[1])
+            if self.profile:
+                self.snapshot = tracemalloc.take_snapshot()
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+        if self.status is None:
+            self.status = "ok" if exc_type is None else "failed"
+        _active.reset(self._token)
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        parent = self.stack[-1] if self.stack else None
+        path = f"{parent[0]}/{name}" if parent is not None and parent[0] else name
+        frame = [path, 0]
+        if self.trace_memory and parent is not None:
+            # What the parent reached so far, before the peak is reset for this stage
+            parent[1] = max(parent[1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.stack.append(frame)
+
+        timer = StageTimer(name)
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.seconds = time.perf_counter() - start
+            self.stack.pop()
+            stats = self.stages.get(path)
+            if stats is None:
+                stats = self.stages[path] = StageStats()
+            stats.calls += 1
+            stats.seconds += timer.seconds
+            if self.trace_memory and parent is not None:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                stats.peak_bytes = max(stats.peak_bytes or 0, peak)
+                parent[1] = max(parent[1], peak)
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount
+
+    def to_dict(self):
+        return {
+            "job": self.job,
+            "status": self.status,
+            "started": self.started,
+            "seconds": self.seconds,
+            "pid": os.getpid(),
+            "stages": {path: stats.to_dict() for path, stats in self.stages.items()},
+            "counters": dict(self.counters),
+            "peak_traced_bytes": self.peak_bytes,
+            "max_rss_bytes": max_rss_bytes(),
+        }
+
+    def dump_profile(self, folder):
+        """Write the cProfile stats (.prof) and the tracemalloc top allocations (.txt) to `folder`."""
+        os.makedirs(folder, exist_ok=True)
+        stem = os.path.join(folder, f"{safe_name(self.job or 'job')}-{os.getpid()}-{int(self.started)}")
+        paths = []
+        if self.profiler is not None:
+            self.profiler.dump_stats(stem + ".prof")
+            paths.append(stem + ".prof")
+        if self.snapshot is not None:
+            with open(stem + ".tracemalloc.txt", 'w', encoding='utf-8') as f:
+                f.write(f"Peak traced memory: {self.peak_bytes} bytes\n")
+                for statistic in self.snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                    f.write(f"{statistic}\n")
+            paths.append(stem + ".tracemalloc.txt")
+        return paths
+
+
+def active():
+    """The Instrumentation of the job running in this thread, or None."""
+    return _active.get()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the current job.
+
+    Yields a StageTimer whose `seconds` is set when the stage ends. It is
+    timed even when no job is being instrumented.
+    """
+    instrumentation = _active.get()
+    if instrumentation is not None:
+        with instrumentation.stage(name) as timer:
+            yield timer
+        return
+
+    timer = StageTimer(name)
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.seconds = time.perf_counter() - start
+
+
+def timed(name=None):
+    """Decorator running a function as a stage, named after the function by default."""
+    def decorate(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def increment(name, amount=1):
+    """Add `amount` to a counter of the current job, if one is being instrumented."""
+    instrumentation = _active.get()
+    if instrumentation is not None:
+        instrumentation.counters[name] += amount
+
+
+def max_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == "Darwin" else rss * 1024
+
+
+def safe_name(name):
+    return re.sub(r'[^\w.-]+', '_', name)
+
+
+def write_json_log(instrumentation, path):
+    """Append the job's summary to `path` as one line of JSON."""
+    line = json.dumps(instrumentation.to_dict()) + "\n"
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+class PrometheusTextfile:
+    """
+    Totals of finished jobs, for node_exporter's textfile collector.
+
+    The process that hands out the jobs (batch, report_service or
+    intake_watcher) records the summary each worker returns (see
+    Instrumentation.to_dict) and rewrites the single file at `path`
+    atomically, so there is one file and one set of series per service
+    however many worker processes come and go.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = collections.Counter()
+        self.job_seconds = 0.0
+        self.stage_calls = collections.Counter()
+        self.stage_seconds = collections.Counter()
+        self.stage_peak_bytes = {}
+        self.counters = collections.Counter()
+        self.max_rss_bytes = None
+
+    def record(self, summary):
+        self.jobs[summary["status"]] += 1
+        self.job_seconds += summary["seconds"]
+        for path, stats in summary["stages"].items():
+            self.stage_calls[path] += stats["calls"]
+            self.stage_seconds[path] += stats["seconds"]
+            if stats["peak_bytes"] is not None:
+                self.stage_peak_bytes[path] = max(self.stage_peak_bytes.get(path, 0), stats["peak_bytes"])
+        self.counters.update(summary["counters"])
+        if summary["max_rss_bytes"] is not None:
+            self.max_rss_bytes = max(self.max_rss_bytes or 0, summary["max_rss_bytes"])
+
+    def lines(self):
+        def metric(name, kind, help_text, samples):
+            yield f"# HELP {name} {help_text}"
+            yield f"# TYPE {name} {kind}"
+            for labels, value in samples:
+                if labels:
+                    labels = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+                    yield f"{name}{{{labels}}} {value}"
+                else:
+                    yield f"{name} {value}"
+
+        yield from metric("report_jobs_total", "counter", "Jobs run, by status.",
+                          [({"status": status}, total) for status, total in sorted(self.jobs.items())])
+        yield from metric("report_job_seconds_total", "counter", "Time spent running jobs.",
+                          [({}, self.job_seconds)])
+        yield from metric("report_stage_calls_total", "counter", "Times each stage ran.",
+                          [({"stage": path}, calls) for path, calls in self.stage_calls.items()])
+        yield from metric("report_stage_seconds_total", "counter", "Time spent in each stage.",
+                          [({"stage": path}, seconds) for path, seconds in self.stage_seconds.items()])
+        if self.stage_peak_bytes:
+            yield from metric("report_stage_peak_bytes", "gauge", "Highest traced memory seen in each stage.",
+                              [({"stage": path}, peak) for path, peak in self.stage_peak_bytes.items()])
+        yield from metric("report_events_total", "counter", "Counted events, e.g. images embedded.",
+                          [({"name": name}, total) for name, total in sorted(self.counters.items())])
+        if self.max_rss_bytes is not None:
+            yield from metric("report_worker_max_rss_bytes", "gauge", "Peak resident memory of the workers.",
+                              [({}, self.max_rss_bytes)])
+
+    def write(self):
+        # Imported here as utils imports this module. node_exporter only
+        # reads *.prom, so it never sees the temporary file
+        from utils import atomic_write
+        with atomic_write(self.path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(self.lines()) + "\n")
+
+    def record_and_write(self, summary):
+        """Add a job's summary, if it has one, and rewrite the file; write errors are printed."""
+        if summary is None:
+            return
+        self.record(summary)
+        try:
+            self.write()
+        except OSError as e:
+            print(f"Could not write {self.path}: {e}")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def env_flag(name):
+    return os.getenv(name, "").lower() in ("1", "true", "yes", "on")
+
+
+@contextmanager
+def instrumented_job(job, log_path=None, profile_folder=None):
+    """
+    Instrument one job and report it when it ends, whether it succeeded or not.
+
+    The job's summary is appended to the JSON lines file `log_path`. With
+    `profile_folder`, the job runs under cProfile and tracemalloc and both
+    are dumped there. They default to environment variables
+    (INSTRUMENTATION_LOG and PROFILE_DIR), so worker processes pick them up
+    too; PROFILE_DIR only applies when PROFILE_JOBS is set. Reporting errors
+    are printed rather than raised. Worker processes return the summary to
+    the process that hands out the jobs, which keeps the PrometheusTextfile.
+    """
+    log_path = log_path or os.getenv('INSTRUMENTATION_LOG') or None
+    if profile_folder is None and env_flag('PROFILE_JOBS'):
+        profile_folder = os.getenv('PROFILE_DIR') or None
+
+    instrumentation = Instrumentation(job, trace_memory=bool(profile_folder), profile=bool(profile_folder))
+    try:
+        with instrumentation:
+            yield instrumentation
+    finally:
+        try:
+            if log_path:
+                write_json_log(instrumentation, log_path)
+            if profile_folder:
+                for path in instrumentation.dump_profile(profile_folder):
+                    print(f"Profile written to {path}")
+        except OSError as e:
+            print(f"Could not write instrumentation for {job}: {e}")
@@ -0,0 +1,221 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from utils import atomic_write, file_hash
+from instrumentation import PrometheusTextfile, instrumented_job
+from wordextraction import extract_and_save
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import shutil
+import time
+import traceback
+import zipfile
+
+
+INPUT_EXTENSIONS = ('.docx', '.docm')
+STATE_FILE_NAME = '.intake-state.json'
+
+
+def process_submission(path, output_folder, db_path=None):
+    """
+    Extract one submission into `output_folder`, and into the RecordStore at
+    `db_path` if given.
+
+    The extraction is written to a temporary folder beside it and renamed
+    into place when complete, so an output folder is never half-written.
+    The result carries the job's instrumentation summary.
+    """
+    instrumentation = None
+    try:
+        temp_folder = f"{output_folder}.{os.getpid()}.partial"
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        with instrumented_job(os.path.basename(path)) as instrumentation:
+            records = extract_and_save(path, temp_folder, image_workers=2, db_path=db_path)
+        if os.path.exists(output_folder):
+            # Left by a run whose state file was lost
+            shutil.rmtree(output_folder)
+        os.replace(temp_folder, output_folder)
+        return {"ok": True, "pictures": sum(1 for picture in records.pictures if picture.image_name),
+                "instrumentation": instrumentation.to_dict()}
+    except Exception as e:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        return {"ok": False, "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc(),
+                "instrumentation": instrumentation.to_dict() if instrumentation is not None else None}
+
+
+class IntakeWatcher:
+    """
+    Extract every input document dropped into `intake_folder`, once.
+
+    The folder is polled every `interval` seconds. A file is taken once its
+    size and modification time have not changed for `settle` seconds and it
+    reads as a complete zip, so documents still being copied in are left
+    alone. Submissions are recognized by content hash: a document already
+    extracted, under any name, is skipped. New ones are extracted on
+    `workers` processes, each into its own folder under `output_root`
+    named after the document and its hash.
+
+    What has been processed is kept in `output_root`/.intake-state.json, so
+    a restarted watcher carries on where it stopped. With `db_path`, every
+    submission is also stored in that RecordStore, and with
+    `metrics_textfile` the extractions are totalled in that Prometheus
+    textfile.
+    """
+
+    def __init__(self, intake_folder, output_root, workers=None, interval=2.0, settle=5.0, db_path=None,
+                 metrics_textfile=None):
+        self.intake_folder = intake_folder
+        self.output_root = output_root
+        self.workers = workers or os.cpu_count() or 1
+        self.interval = interval
+        self.settle = settle
+        self.db_path = db_path
+        self.textfile = PrometheusTextfile(metrics_textfile) if metrics_textfile else None
+        self.state_path = os.path.join(output_root, STATE_FILE_NAME)
+        self.state = self.load_state()
+        # path -> (size, mtime) at the last poll, for the debounce
+        self.last_seen = {}
+        # path -> (size, mtime, hash) of files already dealt with, to skip rehashing them
+        self.known = {}
+        # future -> (path, hash, output folder)
+        self.running = {}
+        # Files seen at the last poll that were still changing
+        self.unsettled = 0
+        os.makedirs(output_root, exist_ok=True)
+
+    def load_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"submissions": {}}
+
+    def save_state(self):
+        with atomic_write(self.state_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=1)
+
+    def ready_files(self, now, once=False):
+        """Yield (path, size, mtime) of the intake files that have stopped changing."""
+        seen = {}
+        with os.scandir(self.intake_folder) as it:
+            for entry in it:
+                # Skip Word's "~$name.docx" lock files and anything else
+                if not entry.is_file() or entry.name.startswith('~$') \
+                        or not entry.name.lower().endswith(INPUT_EXTENSIONS):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                current = (stat.st_size, stat.st_mtime)
+                seen[entry.path] = current
+                known = self.known.get(entry.path)
+                if known is not None and known[:2] == current:
+                    continue
+                # Unchanged since the last poll (or, in a single pass, old enough)
+                stable = once or self.last_seen.get(entry.path) == current
+                if stable and now - stat.st_mtime >= self.settle:
+                    yield entry.path, stat.st_size, stat.st_mtime
+                else:
+                    self.unsettled += 1
+        self.last_seen = seen
+
+    def poll(self, executor, once=False):
+        """Submit the new ready files, as far as there are free workers; return how many were left waiting."""
+        waiting = 0
+        self.unsettled = 0
+        in_flight = {path: digest for path, digest, _ in self.running.values()}
+        for path, size, mtime in self.ready_files(time.time(), once):
+            if path in in_flight:
+                continue
+            if not zipfile.is_zipfile(path):
+                # Looked at again only once it changes
+                self.known[path] = (size, mtime, None)
+                print(f"SKIP   {path}: not a complete Word document")
+                continue
+            if len(self.running) >= self.workers * 2:
+                waiting += 1
+                continue
+
+            digest = file_hash(path)
+            self.known[path] = (size, mtime, digest)
+            submission = self.state["submissions"].get(digest)
+            if submission is not None:
+                if submission["source"] != os.path.basename(path):
+                    print(f"SKIP   {path}: same document as {submission['source']}")
+                continue
+            if digest in in_flight.values():
+                print(f"SKIP   {path}: same document as one being extracted")
+                continue
+
+            stem = os.path.splitext(os.path.basename(path))[0]
+            output_folder = os.path.join(self.output_root, f"{stem}-{digest[:12]}")
+            future = executor.submit(process_submission, path, output_folder, self.db_path)
+            self.running[future] = (path, digest, output_folder)
+            in_flight[path] = digest
+            print(f"START  {path}")
+        return waiting
+
+    def collect(self, timeout):
+        """Record the submissions that finish within `timeout` seconds."""
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            path, digest, output_folder = self.running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process itself died (e.g. BrokenProcessPool)
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            if self.textfile is not None:
+                self.textfile.record_and_write(result.get("instrumentation"))
+
+            submission = {"source": os.path.basename(path), "processed": time.time(), "ok": result["ok"]}
+            if result["ok"]:
+                submission["output"] = output_folder
+                submission["pictures"] = result["pictures"]
+                print(f"OK     {path} -> {output_folder}")
+            else:
+                # Recorded too, so a broken document isn't retried on every poll; changing it retries it
+                submission["error"] = result["error"]
+                print(f"FAILED {path}: {result['error']}")
+            self.state["submissions"][digest] = submission
+        if done:
+            self.save_state()
+
+    def run(self, once=False):
+        """Watch the intake folder until interrupted, or with `once` until what is there now is done."""
+        print(f"Watching {self.intake_folder}, writing to {self.output_root}")
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                waiting = self.poll(executor, once)
+                if once and not self.running and not waiting and not self.unsettled:
+                    break
+                self.collect(self.interval)
+
+
+if __name__ == "__main__":
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description="Extract filled-in ReportInputsTemplate documents as they arrive.")
+    parser.add_argument("intake_folder", help="folder the documents are dropped into")
+    parser.add_argument("output_root", help="folder to create one output folder per submission in")
+    parser.add_argument("--workers", type=int, default=None, help="number of extraction processes (default: CPU count)")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between polls (default: 2)")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="seconds a file must be unchanged before it is taken (default: 5)")
+    parser.add_argument("--once", action="store_true", help="process what is in the folder now and exit")
+    parser.add_argument("--db", help="SQLite database to also keep the extracted records in")
+    parser.add_argument("--metrics-textfile", default=os.getenv('PROMETHEUS_TEXTFILE') or None,
+                        help="Prometheus textfile to keep extraction totals in (default: PROMETHEUS_TEXTFILE)")
+    args = parser.parse_args()
+
+    watcher = IntakeWatcher(args.intake_folder, args.output_root, args.workers, args.interval, args.settle,
+                            args.db, args.metrics_textfile)
+    try:
+        watcher.run(args.once)
+    except KeyboardInterrupt:
+        pass
@@ -1,12 +1,7 @@
-from docx import Document
-from docx.opc.coreprops import CoreProperties
-from docx.shared import Inches
-from utils import add_table_with_images
-from utils import replace_text_in_table
-from utils import add_captions_with_win32com
-from utils import add_bullets_above_tables
-from utils import append_cross_references_to_bullets
-from utils import delete_template_bullets
+from report_builder import ReportBuilder
+from template_cache import compile_template
+from instrumentation import instrumented_job
+from utils import CUSTOM_PROPERTY_NAMES
 from dotenv import load_dotenv
 import os
 
@@ -16,6 +11,7 @@ import os
 load_dotenv(override=True)
 template_file_path = os.getenv('TEMPLATE_DOC_PATH')
 output_doc_file_path = os.getenv('OUTPUT_REPORT_DOC_PATH')
+image_cache_folder = os.getenv('IMAGE_CACHE_DIR') or None
 
 # Inputs
 image_path_1 = r"C:\Users\phpai\OneDrive\Desktop\report-automation\Images\image1.jpeg"
@@ -33,48 +29,19 @@ doc_core_properties = {
     "keywords": "keywords", # maverick job num
 }
 
-custom_properties = {
-    "customer address": "customer address",
-    "customer contact": "customer contact",
-    "inspection site": "inspection site",
-    "customer po num": "customer po num",
-    "customer ccs": "customer css",
-    "inspection date": "inspection date",
-    "company": "company",
-    "maverick contact info": "maverick contact info",
-    "maverick ccs": "maverick ccs",
-    "report date": "report date",
-}
+# Each placeholder filled with its own name, to show where it ends up
+custom_properties = {name: name for name in CUSTOM_PROPERTY_NAMES}
 
 if __name__ == "__main__":
 
-    # Open an existing document
-    doc = Document(template_file_path)
-
-    # Modify core properties
-    core_properties = doc.core_properties
-    # Set core properties
-    core_properties.title = doc_core_properties["title"]
-    core_properties.author = doc_core_properties["author"]
-    core_properties.subject = doc_core_properties["subject"]
-    core_properties.keywords = doc_core_properties["keywords"]
-
-    # Iterate through all tables (if any)
-    for table in doc.tables:
-        replace_text_in_table(table, custom_properties.keys(), custom_properties.values())
-
-    add_table_with_images(doc, "Inspection Observations:", image_path_1, image_path_2)
-
-    # Save the modified document
-    doc.save(output_doc_file_path)
-
-    # Add captions to images
-    add_captions_with_win32com(output_doc_file_path, images)
-
-    # Add bullets above table
-    doc = add_bullets_above_tables(output_doc_file_path)
-
-    delete_template_bullets(doc, output_doc_file_path)
-
-    # Add cross references
-    append_cross_references_to_bullets(output_doc_file_path)
\ No newline at end of file
+    builder = ReportBuilder(
+        compile_template(template_file_path),
+        output_doc_file_path,
+        doc_core_properties,
+        custom_properties,
+        images,
+        image_cache=image_cache_folder,
+    )
+    with instrumented_job(os.path.basename(output_doc_file_path)):
+        builder.build()
+    builder.print_timings()
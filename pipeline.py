@@ -0,0 +1,124 @@
+from wordextraction import extract_records, write_csvs
+from report_builder import ReportBuilder
+from sinks import DirectorySink, MemorySink
+from utils import CUSTOM_PROPERTY_NAMES, ImageRecord
+from instrumentation import instrumented_job
+from dotenv import load_dotenv
+import argparse
+import os
+import re
+import tempfile
+
+
+# Header table labels of the input form and the report fields they fill
+CORE_PROPERTY_FIELDS = {
+    "Customer:": "title",
+    "From:": "author",
+    "Subject:": "subject",
+    "Maverick Job:": "keywords",
+}
+
+CUSTOM_PROPERTY_FIELDS = dict(zip([
+    "Customer Address:", "Customer Contact:", "Inspection Site:", "Customer PO No.:", "Customer CCs:",
+    "Inspection Date(s):", "Company:", "Maverick Contact Info:", "Maverick CCs:", "Report Date:",
+], CUSTOM_PROPERTY_NAMES))
+
+# Inputs up to this size are extracted and processed in memory
+IN_MEMORY_INPUT_BYTES = 64 * 1024 * 1024
+
+
+def report_inputs(records, images):
+    """
+    Map extracted InputRecords to ReportBuilder inputs.
+
+    Returns (core_properties, custom_properties, image records). Empty
+    header fields are left out so the template placeholder stays visible.
+    `images` maps each picture's image_name to its bytes, or to the path of
+    the file holding them.
+    """
+    core_properties = {}
+    custom_properties = {}
+    for field in records.header_fields:
+        if not field.value:
+            continue
+        if field.name in CORE_PROPERTY_FIELDS:
+            core_properties[CORE_PROPERTY_FIELDS[field.name]] = field.value
+        elif field.name in CUSTOM_PROPERTY_FIELDS:
+            custom_properties[CUSTOM_PROPERTY_FIELDS[field.name]] = field.value
+
+    image_records = []
+    for picture in records.pictures:
+        if not picture.image_name:
+            continue
+        # Descriptions are written as "Figure shows ...": the bullet's
+        # cross-reference supplies the "Figure N"
+        description = re.sub(r"^\s*Figure\s+", "", picture.description)
+        image = images[picture.image_name]
+        if isinstance(image, str):
+            image_records.append(ImageRecord(picture.file_name, description, picture.caption, data_path=image))
+        else:
+            image_records.append(ImageRecord(picture.file_name, description, picture.caption, image))
+
+    return core_properties, custom_properties, image_records
+
+
+def build_report_from_inputs(input_path, template, output_path, audit_folder=None, update=False,
+                             db_path=None, in_memory_limit=IN_MEMORY_INPUT_BYTES, **builder_options):
+    """
+    Build a report straight from a filled-in ReportInputsTemplate.
+
+    The input is streamed into records. When it is at most `in_memory_limit`
+    bytes, its pictures are kept in memory and processed there, so nothing is
+    written to disk except the report itself. A larger input's pictures go to
+    a temporary folder that is removed once the report is saved, so memory
+    use doesn't grow with the number of pictures. The extraction CSVs are
+    written too when an `audit_folder` is given. With `update`, a report
+    built earlier is patched for the changed inputs instead of rebuilt.
+    With `db_path`, the extracted records are also kept in that RecordStore.
+    """
+    if os.path.getsize(input_path) <= in_memory_limit:
+        sink = MemorySink()
+        records = extract_records(input_path, sink, db_path=db_path)
+        # Processed images stay in memory as well
+        builder_options.setdefault("spill_images", False)
+        return run_builder(records, sink.images, template, output_path, audit_folder, update, builder_options)
+
+    with tempfile.TemporaryDirectory(prefix="report-inputs-") as picture_folder:
+        sink = DirectorySink(picture_folder)
+        records = extract_records(input_path, sink, db_path=db_path)
+        pictures = {name: os.path.join(picture_folder, name) for name in os.listdir(picture_folder)}
+        return run_builder(records, pictures, template, output_path, audit_folder, update, builder_options)
+
+
+def run_builder(records, pictures, template, output_path, audit_folder, update, builder_options):
+    if audit_folder:
+        write_csvs(records, audit_folder)
+    core_properties, custom_properties, images = report_inputs(records, pictures)
+    builder = ReportBuilder(template, output_path, core_properties, custom_properties, images, **builder_options)
+    if update:
+        builder.update()
+    else:
+        builder.build()
+    return builder
+
+
+if __name__ == "__main__":
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description="Build a report from a filled-in ReportInputsTemplate.")
+    parser.add_argument("input", help="filled-in ReportInputsTemplate (.docm or .docx)")
+    parser.add_argument("output", nargs="?", default=os.getenv('OUTPUT_REPORT_DOC_PATH'),
+                        help="report to write (default: OUTPUT_REPORT_DOC_PATH)")
+    parser.add_argument("--template", default=os.getenv('TEMPLATE_DOC_PATH'), help="Word template (default: TEMPLATE_DOC_PATH)")
+    parser.add_argument("--audit-folder", help="also write the extracted CSVs to this folder")
+    parser.add_argument("--update", action="store_true",
+                        help="patch the report built earlier from this input instead of rebuilding it")
+    parser.add_argument("--record-db", default=os.getenv('RECORD_DB_PATH') or None,
+                        help="SQLite database to also keep the extracted records in (default: RECORD_DB_PATH)")
+    args = parser.parse_args()
+
+    with instrumented_job(os.path.basename(args.input)):
+        builder = build_report_from_inputs(args.input, args.template, args.output, args.audit_folder, args.update,
+                                           args.record_db, image_cache=os.getenv('IMAGE_CACHE_DIR') or None)
+    builder.print_timings()
@@ -0,0 +1,252 @@
+from PIL import Image
+from instrumentation import timed
+from utils import CHUNK_SIZE, file_hash
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# Bump when the schema changes
+SCHEMA_VERSION = 1
+
+# The input form's header field that becomes the report's keywords (see pipeline.CORE_PROPERTY_FIELDS)
+JOB_NUMBER_FIELD = "Maverick Job:"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    sha256 TEXT NOT NULL UNIQUE,
+    job_number TEXT,
+    extracted REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS header_fields (
+    document_id INTEGER NOT NULL REFERENCES documents(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS text_blocks (
+    document_id INTEGER NOT NULL REFERENCES documents(id),
+    position INTEGER NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER
+);
+CREATE TABLE IF NOT EXISTS pictures (
+    document_id INTEGER NOT NULL REFERENCES documents(id),
+    position INTEGER NOT NULL,
+    row_index TEXT NOT NULL,
+    description TEXT NOT NULL,
+    caption TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    image_sha256 TEXT REFERENCES images(sha256)
+);
+CREATE INDEX IF NOT EXISTS documents_job_number ON documents(job_number);
+CREATE INDEX IF NOT EXISTS pictures_image_sha256 ON pictures(image_sha256);
+CREATE INDEX IF NOT EXISTS pictures_document ON pictures(document_id);
+CREATE INDEX IF NOT EXISTS header_fields_document ON header_fields(document_id);
+CREATE INDEX IF NOT EXISTS text_blocks_document ON text_blocks(document_id);
+"""
+
+
+class RecordStore:
+    """
+    A SQLite index of extracted input documents and their pictures.
+
+    Each document's header fields, text blocks and picture rows are stored
+    under its content hash, with its job number (the header field that
+    becomes the report's keywords) indexed. Pictures are kept once each in a
+    content-addressed folder, `images/` beside the database unless given,
+    so a photo reused across jobs is stored and found by its hash.
+
+    The database is in WAL mode, so several extraction processes can write
+    to it while others read.
+    """
+
+    def __init__(self, db_path, image_folder=None):
+        self.db_path = db_path
+        self.image_folder = image_folder or os.path.join(os.path.dirname(os.path.abspath(db_path)), "images")
+        os.makedirs(self.image_folder, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self.connection:
+                self.connection.executescript(SCHEMA)
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def sink(self, inner=None):
+        """An image sink that stores each picture here, and also writes it to `inner` if given."""
+        return StoringSink(self, inner)
+
+    @timed("store records")
+    def add_document(self, source_path, sha256, records, images):
+        """
+        Store the InputRecords of one document, in a single transaction.
+
+        `images` maps image_name to (sha256, path, size, width, height), as
+        collected by a StoringSink. A document stored earlier with the same
+        content is replaced. Returns the document's id.
+        """
+        job_number = next((field.value for field in records.header_fields if field.name == JOB_NUMBER_FIELD), None)
+        with self.connection:
+            cursor = self.connection.cursor()
+            old = cursor.execute("SELECT id FROM documents WHERE sha256 = ?", (sha256,)).fetchone()
+            if old is not None:
+                for table in ("header_fields", "text_blocks", "pictures"):
+                    cursor.execute(f"DELETE FROM {table} WHERE document_id = ?", (old["id"],))
+                cursor.execute("DELETE FROM documents WHERE id = ?", (old["id"],))
+
+            cursor.execute("INSERT INTO documents (source, sha256, job_number, extracted) VALUES (?, ?, ?, ?)",
+                           (os.path.abspath(source_path), sha256, job_number or None, time.time()))
+            document_id = cursor.lastrowid
+
+            cursor.executemany("INSERT OR IGNORE INTO images (sha256, path, size, width, height) VALUES (?, ?, ?, ?, ?)",
+                               images.values())
+            cursor.executemany("INSERT INTO header_fields VALUES (?, ?, ?, ?)",
+                               [(document_id, i, field.name, field.value)
+                                for i, field in enumerate(records.header_fields)])
+            cursor.executemany("INSERT INTO text_blocks VALUES (?, ?, ?)",
+                               [(document_id, i, block.content) for i, block in enumerate(records.text_blocks)])
+            cursor.executemany("INSERT INTO pictures VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(document_id, i, picture.index, picture.description, picture.caption,
+                                 picture.file_name, images[picture.image_name][0] if picture.image_name else None)
+                                for i, picture in enumerate(records.pictures)])
+        return document_id
+
+    def documents(self, job_number):
+        return self.connection.execute(
+            "SELECT * FROM documents WHERE job_number = ? ORDER BY extracted", (job_number,)).fetchall()
+
+    def pictures(self, job_number=None, image_sha256=None):
+        """Picture rows with an image, with their document and image, by job number and/or image hash."""
+        query = ("SELECT documents.source, documents.job_number, pictures.row_index, pictures.description, "
+                 "pictures.caption, pictures.file_name, images.* FROM pictures "
+                 "JOIN documents ON documents.id = pictures.document_id "
+                 "JOIN images ON images.sha256 = pictures.image_sha256")
+        conditions, parameters = [], []
+        if job_number is not None:
+            conditions.append("documents.job_number = ?")
+            parameters.append(job_number)
+        if image_sha256 is not None:
+            conditions.append("pictures.image_sha256 = ?")
+            parameters.append(image_sha256)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.connection.execute(query + " ORDER BY documents.extracted, pictures.position",
+                                       parameters).fetchall()
+
+    def image_path(self, relative_path):
+        return os.path.join(self.image_folder, relative_path)
+
+
+class HashingReader:
+    # Passes reads through, hashing them and copying them to `copy`
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sha256.update(data)
+        self.copy.write(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class StoringSink:
+    """
+    Store images in a RecordStore's content-addressed folder as they are written.
+
+    Each image is hashed while it is copied, then kept as
+    `<hash[:2]>/<hash><extension>` unless the store has it already. The
+    stored images are collected in `images`, by name, for add_document().
+    """
+
+    def __init__(self, store, inner=None):
+        self.store = store
+        self.inner = inner
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def write(self, name, source, size=None):
+        folder = self.store.image_folder
+        temp_path = os.path.join(folder, f"{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temp_path, 'wb') as copy:
+                reader = HashingReader(source, copy)
+                if self.inner is not None:
+                    self.inner.write(name, reader, size)
+                reader.drain()
+            sha256 = reader.sha256.hexdigest()
+
+            relative_path = os.path.join(sha256[:2], sha256 + os.path.splitext(name)[1].lower())
+            path = os.path.join(folder, relative_path)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception:
+            # Not a format Pillow reads, e.g. EMF
+            width = height = None
+        with self.lock:
+            self.images[name] = (sha256, relative_path, reader.size, width, height)
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+    def __str__(self):
+        if self.inner is not None:
+            return f"{self.inner} and {self.store.image_folder}"
+        return self.store.image_folder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up extracted pictures in a record store.")
+    parser.add_argument("db", help="SQLite database written by extraction with a db_path")
+    parser.add_argument("--job", help="job number to list the pictures of")
+    parser.add_argument("--image", help="image file to find earlier uses of, by content")
+    args = parser.parse_args()
+
+    image_sha256 = None
+    if args.image:
+        image_sha256 = file_hash(args.image)
+
+    with RecordStore(args.db) as store:
+        for row in store.pictures(args.job, image_sha256):
+            print(f"{row['job_number'] or '-':<16}{row['row_index']:>4}  {row['file_name']:<32}"
+                  f"{row['caption']:<32}{store.image_path(row['path'])}")
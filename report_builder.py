@@ -0,0 +1,248 @@
+from docx import Document
+from docx_writer import save_document
+from utils import add_image_tables
+from utils import ImageRecord
+from utils import image_width_for
+from image_processing import preprocess_images
+from image_cache import ImageCache
+from template_cache import CompiledTemplate
+from utils import replace_placeholders
+from utils import PlaceholderReplacer
+from utils import place_bullets
+from utils import add_captions
+from utils import add_cross_references_to_bullets
+from utils import caption_bookmarks
+from instrumentation import stage
+from incremental import ReportRevision, input_manifest, load_manifest, patch_report, save_manifest
+from docx.oxml.ns import qn
+import itertools
+import tempfile
+
+
+class ReportBuilder:
+    """
+    Build a report from the template in a single pass.
+
+    The template is loaded once and every stage works on the same in-memory
+    Document. The document is serialized exactly once, at the end of the
+    pipeline, and the time spent in each stage is recorded in `timings`
+    (and in the job's Instrumentation, when one is active).
+    """
+
+    def __init__(self, template, output_path, core_properties, custom_properties, images,
+                 header_text="Inspection Observations:", columns=2, rows_per_table=None, page_break=False,
+                 preprocess=True, image_dpi=200, image_quality=85, image_workers=None, image_cache=None,
+                 manifest=True, xml_compress_level=6, spill_images=True):
+        self.template = template
+        self.output_path = output_path
+        self.core_properties = core_properties
+        self.custom_properties = custom_properties
+        self.images = images
+        self.header_text = header_text
+        self.columns = columns
+        self.rows_per_table = rows_per_table
+        self.page_break = page_break
+        self.preprocess = preprocess
+        self.image_dpi = image_dpi
+        self.image_quality = image_quality
+        self.image_workers = image_workers
+        # Folder of processed images shared between runs, or an ImageCache
+        if isinstance(image_cache, str):
+            image_cache = ImageCache(image_cache)
+        self.image_cache = image_cache
+        # Write <report>.manifest.json so update() can patch the report later
+        self.manifest = manifest
+        # Deflate level of the report's XML parts; images are stored uncompressed
+        self.xml_compress_level = xml_compress_level
+        # Keep processed images in a temporary folder until the save, not in memory
+        self.spill_images = spill_images
+        self.spill_folder = None
+        self.doc = None
+        # Indexed template elements, when built from a CompiledTemplate
+        self.template_elements = None
+        self.figures = []
+        self.image_tables = []
+        self.timings = []
+
+    def stages(self):
+        # Ordered (name, callable) pairs run by build()
+        stages = [
+            ("load template", self.load_template),
+            ("core properties", self.set_core_properties),
+            ("replace placeholders", self.replace_placeholders),
+            ("image tables", self.add_image_tables),
+            ("bullets", self.add_bullets),
+            ("captions", self.add_captions),
+            ("cross-references", self.add_cross_references),
+            ("save", self.save),
+        ]
+        if self.manifest:
+            stages.append(("manifest", self.save_manifest))
+        return stages
+
+    def build(self):
+        self.timings = []
+        try:
+            for name, function in self.stages():
+                self.run_stage(name, function)
+        finally:
+            self.cleanup()
+        return self.output_path
+
+    def run_stage(self, name, function):
+        with stage(name) as timer:
+            result = function()
+        self.timings.append((name, timer.seconds))
+        return result
+
+    def update(self):
+        """
+        Bring the report of an earlier build() up to date with the inputs.
+
+        The inputs are compared with the manifest saved beside the report and
+        only the captions, bullets and pictures that changed are patched into
+        it, along with any figures added at the end; unchanged image parts
+        are kept as they are. Changes a patch can't express, such as new
+        custom properties or removed figures, fall back to a full build().
+        """
+        try:
+            return self._update()
+        finally:
+            self.cleanup()
+
+    def _update(self):
+        self.timings = []
+        self.figures = []
+        self.images = list(self.record_figures(self.images))
+        revision = self.run_stage("diff", lambda: ReportRevision(self.output_path, load_manifest(self.output_path),
+                                                                 input_manifest(self)))
+        print(f"Revision: {revision}")
+        if revision.rebuild:
+            return self.build()
+        if revision.is_empty():
+            return self.output_path
+
+        self.doc = self.run_stage("load report", lambda: Document(self.output_path))
+        bookmarks = self.run_stage("patch", lambda: patch_report(self.doc, self, revision,
+                                                                 self.revised_images(revision)))
+        if bookmarks is None:
+            # Start again from the template, with a fresh folder for its images
+            self.cleanup()
+            return self.build()
+        self.run_stage("save", self.save)
+        self.run_stage("manifest", lambda: save_manifest(self, bookmarks))
+        return self.output_path
+
+    def revised_images(self, revision):
+        # The changed and appended figures, by position, processed as build() would
+        positions = revision.pictures + revision.appended
+        images = [self.figures[i] for i in positions]
+        if self.preprocess:
+            images = preprocess_images(images, image_width_for(self.columns), dpi=self.image_dpi,
+                                       quality=self.image_quality, workers=self.image_workers,
+                                       cache=self.image_cache, spill_folder=self.image_spill_folder())
+        return dict(zip(positions, images))
+
+    def load_template(self):
+        # Accept a path to the template, a CompiledTemplate or an already parsed Document
+        if isinstance(self.template, CompiledTemplate):
+            self.doc = self.template.new_document()
+            self.template_elements = self.template.resolve(self.doc)
+        elif isinstance(self.template, str):
+            self.doc = Document(self.template)
+        else:
+            self.doc = self.template
+
+    def set_core_properties(self):
+        core_properties = self.doc.core_properties
+        for name in ["title", "author", "subject", "keywords"]:
+            if name in self.core_properties:
+                setattr(core_properties, name, self.core_properties[name])
+
+    def replace_placeholders(self):
+        if self.template_elements is not None and set(self.custom_properties) <= self.template.placeholders:
+            # Only the paragraphs the index says hold placeholders
+            replacer = PlaceholderReplacer(self.custom_properties)
+            for p in self.template_elements["placeholder paragraphs"]:
+                replacer.replace_in_paragraph(p)
+            print(f"Replaced {replacer.count} placeholders")
+        else:
+            replace_placeholders(self.doc, self.custom_properties)
+
+    def add_image_tables(self):
+        self.figures = []
+        images = self.record_figures(self.images)
+        if self.preprocess:
+            # Downscale and recompress for the cell width before embedding
+            images = preprocess_images(images, image_width_for(self.columns), dpi=self.image_dpi,
+                                       quality=self.image_quality, workers=self.image_workers,
+                                       cache=self.image_cache, spill_folder=self.image_spill_folder())
+        self.image_tables = add_image_tables(self.doc, self.header_text, images,
+                         columns=self.columns, rows_per_table=self.rows_per_table, page_break=self.page_break,
+                         anchor=self.template_anchor())
+
+    def image_spill_folder(self):
+        if not self.spill_images:
+            return None
+        if self.spill_folder is None:
+            if self.image_cache is not None:
+                # Beside the cache, so cached images can be hard-linked rather than copied
+                self.spill_folder = self.image_cache.spill_folder()
+            else:
+                self.spill_folder = tempfile.TemporaryDirectory(prefix="report-images-")
+        return self.spill_folder.name
+
+    def cleanup(self):
+        # The spilled images are only needed until the report is saved. The
+        # document's image parts read them, so it goes too rather than
+        # failing on a later save; the saved report is at output_path
+        self.doc = None
+        if self.spill_folder is not None:
+            self.spill_folder.cleanup()
+            self.spill_folder = None
+
+    def template_anchor(self):
+        if self.template_elements is None:
+            return None
+        return self.template_elements["anchors"].get(self.header_text)
+
+    def record_figures(self, images):
+        # Images are consumed lazily; only their records are kept for the captions
+        for image in images:
+            if isinstance(image, str):
+                image = ImageRecord(image)
+            self.figures.append(image)
+            yield image
+
+    def add_bullets(self):
+        # One bullet per figure: its description, or a "Bullet point k" placeholder.
+        # The template bullets are removed in the same pass over the body.
+        bullets = []
+        figures = iter(self.figures)
+        for table in self.image_tables:
+            count = len(table._tbl.findall('.//' + qn('w:drawing')))
+            bullets.append([figure.description or f"Bullet point {k}"
+                            for k, figure in enumerate(itertools.islice(figures, count), start=1)])
+        template_bullets = None
+        if self.template_elements is not None:
+            template_bullets = self.template_elements["template bullets"]
+        place_bullets(self.doc, bullets, self.image_tables, template_bullets)
+
+    def add_captions(self):
+        add_captions(self.doc, self.figures, self.image_tables)
+
+    def add_cross_references(self):
+        add_cross_references_to_bullets(self.doc)
+
+    def save(self):
+        save_document(self.doc, self.output_path, self.xml_compress_level)
+
+    def save_manifest(self):
+        bookmarks = [name for table in self.image_tables for name, _ in caption_bookmarks(table._tbl, "Figure")]
+        save_manifest(self, bookmarks)
+
+    def print_timings(self):
+        total = sum(seconds for _, seconds in self.timings)
+        for name, seconds in self.timings:
+            print(f"{name:<32}{seconds * 1000:>10.1f} ms")
+        print(f"{'total':<32}{total * 1000:>10.1f} ms")
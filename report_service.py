@@ -0,0 +1,348 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from batch import CORE_PROPERTY_NAMES, init_worker, run_job
+from utils import ImageRecord
+from instrumentation import PrometheusTextfile
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import statistics
+import time
+import uuid
+
+
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# Finished jobs whose status is kept, and completions the latency figures cover
+JOB_HISTORY = 1000
+LATENCY_SAMPLES = 500
+
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class JobError(Exception):
+    """A submitted job that can't be accepted, with the HTTP status to answer."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def job_from_request(body):
+    """
+    Validate a submitted job and return it in batch.run_job's form.
+
+    The body is JSON like:
+        {"output": "...", "core_properties": {...}, "custom_properties": {...},
+         "images": ["photo.jpg", {"path": "...", "description": "...", "caption": "..."}],
+         "update": false}
+    Paths should be absolute, as they are resolved by the service.
+    """
+    try:
+        request = json.loads(body)
+    except ValueError as e:
+        raise JobError(f"Invalid JSON: {e}")
+    if not isinstance(request, dict) or not isinstance(request.get("output"), str):
+        raise JobError("A job needs an \"output\" path")
+
+    core_properties = string_mapping(request, "core_properties")
+    unknown = set(core_properties) - set(CORE_PROPERTY_NAMES)
+    if unknown:
+        raise JobError(f"Unknown core properties: {', '.join(sorted(unknown))}")
+    custom_properties = string_mapping(request, "custom_properties")
+
+    if not isinstance(request.get("images", []), list):
+        raise JobError("\"images\" must be a list")
+    images = []
+    for image in request.get("images", []):
+        if isinstance(image, str):
+            images.append(ImageRecord(image))
+        elif isinstance(image, dict) and isinstance(image.get("path"), str) \
+                and isinstance(image.get("description", ""), str) and isinstance(image.get("caption", ""), str):
+            images.append(ImageRecord(image["path"], image.get("description", ""), image.get("caption", "")))
+        else:
+            raise JobError(f"Invalid image {image!r}, expected a path or {{\"path\": ...}}")
+
+    return {
+        "output": os.path.abspath(request["output"]),
+        "core_properties": core_properties,
+        "custom_properties": custom_properties,
+        "images": images,
+        "update": bool(request.get("update")),
+    }
+
+
+def string_mapping(request, name):
+    # An optional object of string values
+    mapping = request.get(name, {})
+    if not isinstance(mapping, dict) or not all(isinstance(value, str) for value in mapping.values()):
+        raise JobError(f"\"{name}\" must be an object with string values")
+    return mapping
+
+
+def warm_up():
+    # Submitted once per worker at start-up, so the processes are started and
+    # their templates compiled before the first job arrives
+    return os.getpid()
+
+
+class ReportService:
+    """
+    Build reports for submitted jobs on a pool of warm worker processes.
+
+    Every worker compiles the template when it starts (batch.init_worker)
+    and then builds report after report from copies of it, compiling it
+    again only when the template file changes. Jobs wait in a
+    queue of at most `max_queue` entries and at most `workers` run at once.
+    When a worker process dies (killed for running out of memory, say), the
+    jobs it was running fail and the pool is replaced with a fresh one.
+    With `metrics_textfile`, the jobs are also totalled in that Prometheus
+    textfile.
+    """
+
+    def __init__(self, template_path, workers=None, max_queue=100, image_cache_folder=None,
+                 metrics_textfile=None):
+        self.template_path = template_path
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.image_cache_folder = image_cache_folder
+        self.textfile = PrometheusTextfile(metrics_textfile) if metrics_textfile else None
+        self.executor = None
+        self.queue = None
+        self.dispatchers = []
+        self.jobs = collections.OrderedDict()
+        self.running = 0
+        self.counts = collections.Counter()
+        self.worker_restarts = 0
+        # Counters of the finished jobs (images embedded, ...), summed
+        self.events = collections.Counter()
+        self.queue_waits = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.run_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.started = time.time()
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        await self.start_workers()
+        print(f"{self.workers} workers started with template {self.template_path}")
+        self.dispatchers = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+
+    async def start_workers(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(self.template_path, self.image_cache_folder))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_up) for _ in range(self.workers)])
+
+    async def restart_workers(self, broken):
+        # Every job running on a broken pool fails; only the first replaces it
+        if broken is not self.executor:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.worker_restarts += 1
+        print("A worker process died, starting new workers")
+        try:
+            await self.start_workers()
+        except BrokenProcessPool as e:
+            # The next job to fail on it tries again
+            print(f"The new workers failed to start: {e}")
+
+    async def close(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, job):
+        """Queue `job` and return its status, or raise JobError when the queue is full."""
+        status = {"id": uuid.uuid4().hex, "status": "queued", "output": job["output"],
+                  "submitted": time.time(), "started": None, "finished": None}
+        try:
+            self.queue.put_nowait((status, job))
+        except asyncio.QueueFull:
+            self.counts["rejected"] += 1
+            raise JobError(f"Queue is full ({self.max_queue} jobs), try again later", 503)
+
+        self.jobs[status["id"]] = status
+        self.counts["submitted"] += 1
+        # Forget the oldest finished jobs
+        while len(self.jobs) > JOB_HISTORY + self.max_queue + self.workers:
+            oldest = next(iter(self.jobs.values()))
+            if oldest["finished"] is None:
+                break
+            self.jobs.popitem(last=False)
+        return status
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            status, job = await self.queue.get()
+            status["status"] = "running"
+            status["started"] = time.time()
+            self.running += 1
+            executor = self.executor
+            broken = False
+            try:
+                result = await loop.run_in_executor(executor, run_job, job)
+            except Exception as e:
+                # The worker process itself died (e.g. BrokenProcessPool)
+                result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                broken = isinstance(e, BrokenProcessPool)
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+
+            status["finished"] = time.time()
+            if self.textfile is not None:
+                self.textfile.record_and_write(result.get("instrumentation"))
+            if result["ok"]:
+                status["status"] = "done"
+                status["timings"] = result["timings"]
+                status["counters"] = result["counters"]
+                self.events.update(result["counters"])
+            else:
+                status["status"] = "failed"
+                status["error"] = result["error"]
+            self.counts[status["status"]] += 1
+            self.queue_waits.append(status["started"] - status["submitted"])
+            self.run_times.append(status["finished"] - status["started"])
+            print(f"{status['status'].upper():<7}{status['id']} {status['output']}")
+            if broken:
+                await self.restart_workers(executor)
+
+    def metrics(self):
+        return {
+            "uptime": time.time() - self.started,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "queue_limit": self.max_queue,
+            "running": self.running,
+            "worker_restarts": self.worker_restarts,
+            "jobs": dict(self.counts),
+            "events": dict(self.events),
+            "queue_wait": latency_summary(self.queue_waits),
+            "run_time": latency_summary(self.run_times),
+        }
+
+    async def handle_connection(self, reader, writer):
+        try:
+            status, response = await self.handle_request(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            status, response = 400, {"error": "Malformed request"}
+        body = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                     f"Content-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def handle_request(self, reader):
+        """Read one HTTP request and return (status, JSON-able response)."""
+        method, path, _ = (await reader.readline()).decode('latin-1').split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            return 413, {"error": f"Request body over {MAX_BODY_BYTES} bytes"}
+        body = await reader.readexactly(length) if length else b""
+
+        path = path.split("?", 1)[0].rstrip("/")
+        if path == "/jobs":
+            if method != "POST":
+                return 405, {"error": "Use POST to submit a job"}
+            try:
+                return 202, self.submit(job_from_request(body))
+            except JobError as e:
+                return e.status, {"error": str(e)}
+        if path.startswith("/jobs/") and method == "GET":
+            job_status = self.jobs.get(path[len("/jobs/"):])
+            if job_status is None:
+                return 404, {"error": "Unknown job"}
+            return 200, job_status
+        if path == "/metrics" and method == "GET":
+            return 200, self.metrics()
+        if path == "/health" and method == "GET":
+            return 200, {"ok": True}
+        return 404, {"error": f"No such endpoint {method} {path}"}
+
+
+def latency_summary(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "samples": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "max": ordered[-1],
+    }
+
+
+async def serve(service, host="127.0.0.1", port=8765, socket_path=None):
+    await service.start()
+    if socket_path:
+        server = await asyncio.start_unix_server(service.handle_connection, socket_path)
+        print(f"Listening on {socket_path}")
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        print(f"Listening on http://{host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, AttributeError):
+            # Windows: Ctrl+C still ends asyncio.run() with KeyboardInterrupt
+            pass
+
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        print("Shutting down")
+        await service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(
+        description="Serve report jobs from warm worker processes.",
+        epilog="Submit with POST /jobs, follow with GET /jobs/<id>, watch GET /metrics.")
+    parser.add_argument("--template", default=os.getenv('TEMPLATE_DOC_PATH'), help="Word template (default: TEMPLATE_DOC_PATH)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--max-queue", type=int, default=100, help="jobs that may wait for a worker (default: 100)")
+    parser.add_argument("--image-cache", default=os.getenv('IMAGE_CACHE_DIR') or None,
+                        help="folder of processed images shared between runs (default: IMAGE_CACHE_DIR)")
+    parser.add_argument("--metrics-textfile", default=os.getenv('PROMETHEUS_TEXTFILE') or None,
+                        help="Prometheus textfile to keep job totals in (default: PROMETHEUS_TEXTFILE)")
+    args = parser.parse_args()
+
+    service = ReportService(args.template, args.workers, args.max_queue, args.image_cache,
+                            args.metrics_textfile)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
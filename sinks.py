@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from utils import CHUNK_SIZE
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+
+
+class DirectorySink:
+    """Write images as files in a folder (the extractor's original behavior)."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, name, source, size=None):
+        with open(os.path.join(self.folder, name), 'wb') as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return self.folder
+
+
+class ArchiveSink:
+    """
+    Write images into a single .zip or .tar(.gz) archive.
+
+    An archive can only take one member at a time, so writes are serialized;
+    the reading and decompressing of the sources still runs in parallel.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path.lower().endswith('.zip'):
+            # Images are already compressed, store them as is
+            self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(path, 'w:gz' if path.lower().endswith(('.tar.gz', '.tgz')) else 'w')
+
+    def write(self, name, source, size=None):
+        with self.lock:
+            if isinstance(self.archive, zipfile.ZipFile):
+                with self.archive.open(name, 'w', force_zip64=True) as target:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                self.archive.addfile(info, source)
+
+    def close(self):
+        self.archive.close()
+
+    def __str__(self):
+        return self.path
+
+
+class MemorySink:
+    """Keep images in the `images` dict, for callers that use them straight away."""
+
+    def __init__(self):
+        self.images = {}
+
+    def write(self, name, source, size=None):
+        self.images[name] = source.read()
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "memory"
+
+
+class ImageWriter:
+    """
+    Write images to a sink from a bounded thread pool.
+
+    submit() blocks once `max_pending` writes are queued, so a fast parser
+    cannot pile up an unbounded backlog of images. The first error raised by
+    a write is re-raised by close().
+    """
+
+    def __init__(self, sink, workers=4, max_pending=16):
+        self.sink = sink
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def submit(self, name, open_source, size=None):
+        """Queue a write of the file-like object returned by `open_source()`."""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write, name, open_source, size)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def _write(self, name, open_source, size):
+        try:
+            with open_source() as source:
+                self.sink.write(name, source, size)
+        except Exception as e:
+            self.errors.append(e)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.sink.close()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't hide the original error behind a write error
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.sink.close()
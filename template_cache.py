@@ -0,0 +1,152 @@
+from docx import Document
+from docx.oxml.ns import qn
+from utils import (CUSTOM_PROPERTY_NAMES, PlaceholderReplacer, TEMPLATE_BULLET_STYLES, atomic_write, document_story_parts,
+                   file_hash, style_ids)
+import copy
+import json
+import os
+
+
+# Bump when the index layout changes so old index files are rebuilt
+INDEX_VERSION = 1
+
+# Placeholders and anchors recorded when none are given
+DEFAULT_PLACEHOLDERS = CUSTOM_PROPERTY_NAMES
+DEFAULT_ANCHORS = ["Inspection Observations:"]
+
+# Compiled templates of this process, by path
+_compiled = {}
+
+
+class CompiledTemplate:
+    """
+    A parsed template plus an index of the elements reports change.
+
+    The index records where the placeholders, anchor paragraphs and template
+    bullets are, as paths of child positions from each part's root element.
+    new_document() returns a deep copy of the parsed template and
+    resolve() turns the index into elements of that copy, so a report needs
+    neither a re-parse nor a scan of the template.
+    """
+
+    def __init__(self, path, document, index):
+        self.path = path
+        self.document = document
+        self.index = index
+        self.placeholders = set(index["placeholders"])
+
+    def new_document(self):
+        return copy.deepcopy(self.document)
+
+    def resolve(self, doc):
+        """Return {"placeholder paragraphs", "anchors", "template bullets"} elements of `doc`."""
+        roots = {part.partname: part.element for part in document_story_parts(doc)}
+        return {
+            "placeholder paragraphs": [element_at(roots[partname], path)
+                                       for partname, path in self.index["placeholder paragraphs"]],
+            "anchors": {text: element_at(doc.element, path) for text, path in self.index["anchors"].items()},
+            "template bullets": [element_at(doc.element, path) for path in self.index["template bullets"]],
+        }
+
+
+def element_path(element, root):
+    path = []
+    while element is not root:
+        parent = element.getparent()
+        path.append(parent.index(element))
+        element = parent
+    return path[::-1]
+
+
+def element_at(root, path):
+    element = root
+    for i in path:
+        element = element[i]
+    return element
+
+
+def build_index(doc, placeholders, anchors):
+    replacer = PlaceholderReplacer({key: key for key in placeholders})
+    index = {
+        "version": INDEX_VERSION,
+        "placeholders": sorted(placeholders),
+        "placeholder paragraphs": [],
+        "anchor texts": anchors,
+        "anchors": {},
+        "template bullets": [],
+    }
+
+    for part in document_story_parts(doc):
+        root = part.element
+        for p in root.iter(qn('w:p')):
+            text = "".join(t.text or "" for t in p.iter(qn('w:t')))
+            if replacer.pattern is not None and replacer.pattern.search(text):
+                index["placeholder paragraphs"].append([part.partname, element_path(p, root)])
+
+    body = doc.element.body
+    bullet_style_ids = style_ids(doc, TEMPLATE_BULLET_STYLES)
+    for p in body.iterchildren(qn('w:p')):
+        text = "".join(t.text or "" for t in p.iter(qn('w:t')))
+        for anchor in anchors:
+            if anchor not in index["anchors"] and anchor in text:
+                index["anchors"][anchor] = element_path(p, doc.element)
+        # Like delete_template_bullets, only the first three
+        if p.style in bullet_style_ids and len(index["template bullets"]) < 3:
+            index["template bullets"].append(element_path(p, doc.element))
+
+    return index
+
+
+def save_index(index, index_path):
+    # Written to a temporary file and renamed, as several workers may compile at once
+    try:
+        with atomic_write(index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    except OSError:
+        # A read-only template folder only loses the on-disk cache
+        pass
+
+
+def compile_template(path, placeholders=None, anchors=None):
+    """
+    Parse the template at `path` and index it, reusing earlier work.
+
+    The compiled template is kept for the life of the process, and the index
+    is saved beside the template as `<template>.index.json`. Both are reused
+    while the template's mtime and size are unchanged; if they changed but
+    the content hash did not, the saved index is still used.
+    """
+    placeholders = sorted(placeholders if placeholders is not None else DEFAULT_PLACEHOLDERS)
+    anchors = list(anchors if anchors is not None else DEFAULT_ANCHORS)
+    stat = os.stat(path)
+
+    compiled = _compiled.get(path)
+    if (compiled is not None and compiled.index["mtime"] == stat.st_mtime and compiled.index["size"] == stat.st_size
+            and compiled.index["placeholders"] == placeholders and set(anchors) <= set(compiled.index["anchor texts"])):
+        return compiled
+
+    document = Document(path)
+    index_path = path + '.index.json'
+    index = None
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    if index is not None and (index.get("version") != INDEX_VERSION or index["placeholders"] != placeholders
+                              or not set(anchors) <= set(index["anchor texts"])):
+        index = None
+    if index is not None and (index["mtime"] != stat.st_mtime or index["size"] != stat.st_size):
+        index = index if index["sha256"] == file_hash(path) else None
+
+    if index is None or index["mtime"] != stat.st_mtime or index["size"] != stat.st_size:
+        if index is None:
+            index = build_index(document, placeholders, anchors)
+            index["sha256"] = file_hash(path)
+        index["mtime"] = stat.st_mtime
+        index["size"] = stat.st_size
+        save_index(index, index_path)
+
+    compiled = _compiled[path] = CompiledTemplate(path, document, index)
+    return compiled
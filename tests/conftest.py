@@ -0,0 +1,25 @@
+import os
+import sys
+
+from PIL import Image
+import pytest
+
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(REPO_FOLDER, "Template Report", "Sample Report - Copy.docx")
+
+# The modules live at the top of the repository
+sys.path.insert(0, REPO_FOLDER)
+
+
+@pytest.fixture
+def photos(tmp_path):
+    """Eight small photos of distinct colours."""
+    folder = tmp_path / "photos"
+    folder.mkdir()
+    paths = []
+    for i in range(8):
+        path = str(folder / f"photo{i}.jpg")
+        Image.new("RGB", (400, 300), (30 * i, 255 - 30 * i, 90)).save(path, quality=90)
+        paths.append(path)
+    return paths
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from utils import atomic_write
+
+
+def test_replaces_the_file_when_the_block_ends(tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text("old")
+    with atomic_write(str(path), 'w', encoding='utf-8') as f:
+        f.write("new")
+        # Readers still see the old file until the rename
+        assert path.read_text() == "old"
+    assert path.read_text() == "new"
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_leaves_the_file_and_no_temporary_file_when_the_block_raises(tmp_path):
+    path = tmp_path / "report.docx"
+    path.write_bytes(b"old")
+    with pytest.raises(ValueError):
+        with atomic_write(str(path), fsync=True) as f:
+            f.write(b"partial")
+            raise ValueError("serializing failed")
+    assert path.read_bytes() == b"old"
+    assert os.listdir(tmp_path) == ["report.docx"]
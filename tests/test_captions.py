@@ -0,0 +1,42 @@
+from docx import Document
+from docx.oxml.ns import qn
+from docx.shared import Inches
+
+from conftest import TEMPLATE
+from report_builder import ReportBuilder
+from utils import ImageRecord
+
+
+def template_with_logo(tmp_path, logo):
+    # The sample template with an inline picture at the top of its body
+    doc = Document(TEMPLATE)
+    doc.paragraphs[0].insert_paragraph_before().add_run().add_picture(logo, width=Inches(1))
+    path = str(tmp_path / "template-with-logo.docx")
+    doc.save(path)
+    return path
+
+
+def paragraph_text(p):
+    return "".join(t.text or "" for t in p.iter(qn('w:t')))
+
+
+def test_pictures_outside_the_image_tables_get_no_caption(tmp_path, photos):
+    report = str(tmp_path / "report.docx")
+    images = [ImageRecord(photos[i], f"item {i}", f"Item {i}") for i in (1, 2)]
+    ReportBuilder(template_with_logo(tmp_path, photos[0]), report, {}, {}, images, image_workers=1).build()
+
+    body = Document(report).element.body
+    logo = next(body.iter(qn('w:drawing')))
+    logo_paragraph = next(logo.iterancestors(qn('w:p')))
+    assert not paragraph_text(logo_paragraph.getnext()).startswith("Figure")
+
+    # Each photo is captioned, numbered from 1, below it in its table
+    for number, drawing in enumerate(list(body.iter(qn('w:drawing')))[1:], start=1):
+        assert next(drawing.iterancestors(qn('w:tbl')), None) is not None
+        caption = next(drawing.iterancestors(qn('w:p'))).getnext()
+        assert paragraph_text(caption) == f"Figure {number}. Item {number}"
+
+    # And every bullet refers to its figure
+    texts = [paragraph_text(p) for p in body.iter(qn('w:p'))]
+    assert "Figure 1 item 1" in texts and "Figure 2 item 2" in texts
+    assert not any(text.startswith("Bullet point") for text in texts)
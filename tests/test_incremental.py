@@ -0,0 +1,219 @@
+from docx import Document
+from docx.oxml.ns import qn
+from docx.oxml import parse_xml
+from lxml import etree
+import hashlib
+import os
+import re
+
+from conftest import TEMPLATE
+import report_builder
+from report_builder import ReportBuilder
+from incremental import patch_report
+from utils import ImageRecord
+
+
+# Attributes that only number things and differ between a patched and a fresh build
+ID_ATTRIBUTES = {qn('w:id'), qn('r:embed'), qn('r:id'), 'id', 'name'}
+
+CUSTOM_PROPERTIES = {"customer address": "1 Main St"}
+
+
+def figures(photos, count):
+    # ImageRecords for the first `count` photos
+    return [ImageRecord(photos[i], f"shows item {i}", f"Item {i}") for i in range(count)]
+
+
+def build(path, images, core_properties=None, custom_properties=CUSTOM_PROPERTIES, update=False, **options):
+    options.setdefault("image_workers", 1)
+    builder = ReportBuilder(TEMPLATE, str(path), dict(core_properties or {}), dict(custom_properties), images,
+                            **options)
+    if update:
+        builder.update()
+    else:
+        builder.build()
+    return builder
+
+
+def stage_names(builder):
+    return [name for name, _ in builder.timings]
+
+
+def normalized_body(path):
+    """The body XML with ids and bookmark names numbered in order of appearance."""
+    body = Document(path).element.body
+    refs = {}
+    for element in body.iter():
+        for name in list(element.attrib):
+            if name in ID_ATTRIBUTES:
+                value = element.get(name)
+                if name == qn('w:name') or not value.startswith("_Ref"):
+                    del element.attrib[name]
+    xml = etree.tostring(body, encoding='unicode')
+    return re.sub(r"_Ref\d+", lambda m: refs.setdefault(m.group(0), f"_Ref{len(refs)}"), xml)
+
+
+def picture_hashes(path):
+    # The image bytes of the pictures, in document order
+    doc = Document(path)
+    return [hashlib.sha1(doc.part.related_parts[blip.get(qn('r:embed'))].blob).hexdigest()
+            for blip in doc.element.body.iter(qn('a:blip'))]
+
+
+def assert_same_report(patched, fresh):
+    assert normalized_body(patched) == normalized_body(fresh)
+    assert picture_hashes(patched) == picture_hashes(fresh)
+
+
+def test_unchanged_inputs_leave_the_report_alone(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    build(report, figures(photos, 3))
+    before = report.read_bytes()
+
+    builder = build(report, figures(photos, 3), update=True)
+
+    assert stage_names(builder) == ["diff"]
+    assert report.read_bytes() == before
+
+
+def test_patch_matches_a_fresh_build(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    build(report, figures(photos, 4))
+
+    new_images = figures(photos, 4)
+    new_images[0] = new_images[0]._replace(caption="A new caption")
+    new_images[1] = new_images[1]._replace(description="shows something else")
+    new_images[2] = new_images[2]._replace(path=photos[6])
+    core_properties = {"title": "Changed title"}
+
+    builder = build(report, new_images, core_properties, update=True)
+    assert "patch" in stage_names(builder)
+    assert "load template" not in stage_names(builder)
+    assert Document(str(report)).core_properties.title == "Changed title"
+
+    fresh = tmp_path / "fresh.docx"
+    build(fresh, new_images, core_properties)
+    assert_same_report(report, fresh)
+
+
+def test_swapped_pictures_drop_unused_image_parts(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    build(report, figures(photos, 2))
+
+    swapped = figures(photos, 2)
+    swapped[0], swapped[1] = swapped[0]._replace(path=photos[1]), swapped[1]._replace(path=photos[0])
+    build(report, swapped, update=True)
+
+    fresh = tmp_path / "fresh.docx"
+    build(fresh, swapped)
+    assert_same_report(report, fresh)
+    # The pictures no longer used are not left in the package
+    assert len(Document(str(report)).part.package.image_parts) == len(Document(str(fresh)).part.package.image_parts)
+
+
+def test_appended_figures_start_new_tables_past_rows_per_table(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    build(report, figures(photos, 3), rows_per_table=2)
+
+    builder = build(report, figures(photos, 7), rows_per_table=2, update=True)
+    assert "patch" in stage_names(builder)
+
+    fresh = tmp_path / "fresh.docx"
+    build(fresh, figures(photos, 7), rows_per_table=2)
+    assert_same_report(report, fresh)
+    assert len(Document(str(report)).tables) == len(Document(str(fresh)).tables)
+
+
+def test_an_update_can_be_updated_again(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    build(report, figures(photos, 2))
+    build(report, figures(photos, 3), update=True)
+
+    new_images = figures(photos, 5)
+    new_images[0] = new_images[0]._replace(caption="Second revision")
+    builder = build(report, new_images, update=True)
+    assert "patch" in stage_names(builder)
+
+    fresh = tmp_path / "fresh.docx"
+    build(fresh, new_images)
+    assert_same_report(report, fresh)
+
+
+def modify_report(report):
+    doc = Document(str(report))
+    doc.add_paragraph("Edited by hand")
+    doc.save(str(report))
+
+
+def test_rebuilds_when_the_patch_can_not_apply(tmp_path, photos):
+    cases = {
+        "no manifest": lambda report: os.remove(str(report) + ".manifest.json"),
+        "report changed since it was built": modify_report,
+    }
+    for reason, break_report in cases.items():
+        report = tmp_path / f"{len(reason)}.docx"
+        build(report, figures(photos, 3))
+        break_report(report)
+
+        builder = build(report, figures(photos, 4), update=True)
+        assert "load template" in stage_names(builder), reason
+
+        fresh = tmp_path / "fresh.docx"
+        build(fresh, figures(photos, 4))
+        assert_same_report(report, fresh)
+
+
+def test_rebuilds_for_changes_a_patch_can_not_express(tmp_path, photos):
+    report = tmp_path / "report.docx"
+    cases = [
+        ("figures removed", dict(images=figures(photos, 2))),
+        ("custom properties changed", dict(images=figures(photos, 3), custom_properties={"company": "ACME"})),
+        ("layout options changed", dict(images=figures(photos, 3), columns=3)),
+    ]
+    for reason, changes in cases:
+        build(report, figures(photos, 3))
+        images = changes.pop("images")
+
+        builder = build(report, images, update=True, **changes)
+        assert "patch" not in stage_names(builder), reason
+        assert "load template" in stage_names(builder), reason
+
+        fresh = tmp_path / "fresh.docx"
+        build(fresh, images, **changes)
+        assert_same_report(report, fresh)
+
+
+def test_rebuilds_when_the_template_has_its_own_figure_captions(tmp_path, photos, monkeypatch):
+    # Appended figures would be numbered after the template's own captions, so patch_report gives up
+    template = tmp_path / "template.docx"
+    doc = Document(TEMPLATE)
+    doc.element.body.insert(0, parse_xml(
+        '<w:p xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        '<w:fldSimple w:instr=" SEQ Figure \\* ARABIC "><w:r><w:t>1</w:t></w:r></w:fldSimple></w:p>'))
+    doc.save(str(template))
+
+    report = tmp_path / "report.docx"
+    cache = str(tmp_path / "cache")
+
+    def build_from_template(images, update=False):
+        builder = ReportBuilder(str(template), str(report), {}, CUSTOM_PROPERTIES, images, image_workers=1,
+                                image_cache=cache)
+        builder.update() if update else builder.build()
+        return builder
+
+    patches = []
+
+    def record_patch(*args, **kwargs):
+        patches.append(patch_report(*args, **kwargs))
+        return patches[-1]
+    monkeypatch.setattr(report_builder, "patch_report", record_patch)
+
+    build_from_template(figures(photos, 2))
+    # Swapped pictures are linked from the cache before the patch gives up and the report is rebuilt
+    images = figures(photos, 3)
+    images[0], images[1] = images[0]._replace(path=photos[1]), images[1]._replace(path=photos[0])
+    builder = build_from_template(images, update=True)
+
+    assert patches == [None]
+    assert "load template" in stage_names(builder)
+    assert len(picture_hashes(str(report))) == 3
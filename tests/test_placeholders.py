@@ -0,0 +1,100 @@
+from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+
+from conftest import TEMPLATE
+from utils import PlaceholderReplacer, replace_placeholders, replace_text_in_table
+
+
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+def paragraph(*runs):
+    """A w:p with one run per text; a (text, True) pair makes a bold run."""
+    xml = ""
+    for run in runs:
+        text, bold = run if isinstance(run, tuple) else (run, False)
+        properties = "<w:rPr><w:b/></w:rPr>" if bold else ""
+        xml += f'<w:r>{properties}<w:t xml:space="preserve">{text}</w:t></w:r>'
+    return parse_xml(f"<w:p {nsdecls('w')}>{xml}</w:p>")
+
+
+def run_texts(p):
+    return [t.text for t in p.iter(qn('w:t'))]
+
+
+def test_placeholder_in_one_run():
+    p = paragraph("Site: inspection site, today")
+    replacer = PlaceholderReplacer({"inspection site": "Plant 4"})
+    assert replacer.replace_in_paragraph(p) == 1
+    assert run_texts(p) == ["Site: Plant 4, today"]
+
+
+def test_placeholder_split_across_runs_keeps_the_formatting_of_each_run():
+    p = paragraph("Customer: ", ("custo", True), "mer add", "ress.")
+    PlaceholderReplacer({"customer address": "1 Main St"}).replace_in_paragraph(p)
+
+    # The replacement goes into the run the placeholder starts in, the others keep what's left
+    assert run_texts(p) == ["Customer: ", "1 Main St", "", "."]
+    assert p.findall(qn('w:r'))[1].find(qn('w:rPr')).find(qn('w:b')) is not None
+
+
+def test_longest_overlapping_key_wins():
+    p = paragraph("customer contact / customer")
+    replacer = PlaceholderReplacer({"customer": "ACME", "customer contact": "J. Smith"})
+    assert replacer.replace_in_paragraph(p) == 2
+    assert run_texts(p) == ["J. Smith / ACME"]
+
+
+def test_replacements_are_not_replaced_again():
+    p = paragraph("company")
+    PlaceholderReplacer({"company": "company ccs", "company ccs": "nobody"}).replace_in_paragraph(p)
+    assert run_texts(p) == ["company ccs"]
+
+
+def test_every_occurrence_is_replaced_and_counted():
+    replacer = PlaceholderReplacer({"report date": "1 May"})
+    first, second = paragraph("report date and report date"), paragraph("rep", "ort date")
+    replacer.replace_in_paragraph(first)
+    replacer.replace_in_paragraph(second)
+    assert run_texts(first) == ["1 May and 1 May"]
+    assert run_texts(second) == ["1 May", ""]
+    assert replacer.count == 3
+
+
+def test_text_with_outer_spaces_is_preserved():
+    p = parse_xml(f"<w:p {nsdecls('w')}><w:r><w:t>company</w:t></w:r><w:r><w:t>X</w:t></w:r></w:p>")
+    PlaceholderReplacer({"company": "ACME "}).replace_in_paragraph(p)
+    t = p.find('.//' + qn('w:t'))
+    assert t.text == "ACME "
+    assert t.get(XML_SPACE) == 'preserve'
+
+
+def test_empty_keys_and_no_matches_change_nothing():
+    p = paragraph("nothing here")
+    assert PlaceholderReplacer({"": "x", "absent": "y"}).replace_in_paragraph(p) == 0
+    assert PlaceholderReplacer({}).replace_in_paragraph(p) == 0
+    assert run_texts(p) == ["nothing here"]
+
+
+def test_replace_text_in_table():
+    doc = Document()
+    table = doc.add_table(rows=1, cols=2)
+    table.cell(0, 0).text = "inspection date"
+    table.cell(0, 1).text = "report date"
+    replace_text_in_table(table, ["inspection date", "report date"], ["2 May", "3 May"])
+    assert [cell.text for cell in table.rows[0].cells] == ["2 May", "3 May"]
+
+
+def test_replace_placeholders_covers_body_tables_headers_and_footers():
+    doc = Document(TEMPLATE)
+    section = doc.sections[0]
+    section.header.add_paragraph("Header: company")
+    section.footer.add_paragraph("Footer: company")
+    doc.add_table(rows=1, cols=1).cell(0, 0).text = "Table: company"
+
+    replace_placeholders(doc, {"company": "ACME"})
+
+    assert section.header.paragraphs[-1].text == "Header: ACME"
+    assert section.footer.paragraphs[-1].text == "Footer: ACME"
+    assert doc.tables[-1].cell(0, 0).text == "Table: ACME"
@@ -1,120 +1,482 @@
-from docx import Document
 from docx.shared import Inches
 from docx.shared import Pt
-import win32com.client as win32
+from docx.shared import RGBColor
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from docx.oxml import OxmlElement, parse_xml
 from docx.oxml.ns import nsdecls
 from docx.oxml.ns import qn
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.table import _Cell
+from docx.text.paragraph import Paragraph
+from image_parts import add_picture
+from instrumentation import increment, timed
+from collections import namedtuple
+from contextlib import contextmanager
 import time
 import os
+import re
+import bisect
+import copy
+import hashlib
+import threading
 
 
+# Bytes read or copied at a time when streaming files
+CHUNK_SIZE = 1024 * 1024
 
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_write(path, mode='wb', encoding=None, fsync=False):
+    """
+    Open a temporary file beside `path` and rename it over `path` once the block ends.
+
+    Readers of `path` see either the old file or the complete new one. If the
+    block raises, the temporary file is removed and `path` is left as it was.
+    The temporary file is named after the process and thread, so concurrent
+    writers never share one, and ends in ".tmp". With `fsync` the data is on
+    disk before the rename.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, mode, encoding=encoding) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Styles of the example bullets in the template that delete_template_bullets removes
+TEMPLATE_BULLET_STYLES = ["List Bullet", "List Bullet 2", "List Bullet 3"]
+
+# Names of the report's custom properties, which are also the template's placeholders
+CUSTOM_PROPERTY_NAMES = [
+    "customer address", "customer contact", "inspection site", "customer po num", "customer ccs",
+    "inspection date", "company", "maverick contact info", "maverick ccs", "report date",
+]
+
+# An image to place in a report table. Description and caption are optional;
+# without a caption the image's file name is used. When `data` is set it is
+# embedded instead of the file at `path`, and likewise the file at
+# `data_path`, which is read only when the report is saved (see
+# image_processing.py and image_parts.py).
+ImageRecord = namedtuple('ImageRecord', ['path', 'description', 'caption', 'data', 'data_path'],
+                         defaults=['', '', None, None])
+
+
+def image_source(image):
+    """The bytes of ImageRecord `image`, or the path of the file holding them."""
+    if image.data is not None:
+        return image.data
+    return image.data_path or image.path
+
+
+@timed()
 def add_table_with_images(doc, header_text, image_path1, image_path2):
-   # Find the paragraph with the header text
+    return add_image_tables(doc, header_text, [image_path1, image_path2])
+
+
+@timed()
+def add_image_tables(doc, header_text, images, columns=2, rows_per_table=None, page_break=False,
+                     table_width=Inches(7.4), anchor=None):
+    """
+    Lay out `images` below the header paragraph in tables of `columns` columns.
+
+    `images` may be any iterable of ImageRecords or paths and is consumed one
+    image at a time. When `rows_per_table` is set, a new table is started
+    after that many rows, separated by an empty paragraph or, with
+    `page_break`, by a page break. Returns the tables that were added.
+
+    `anchor` is the header's w:p when it is already known (see
+    template_cache.py), which saves searching the document for it.
+    """
+    # Find the paragraph with the header text
     target_paragraph = None
-    for paragraph in doc.paragraphs:
-        if header_text in paragraph.text:
-            target_paragraph = paragraph
-            break
+    if anchor is not None:
+        target_paragraph = Paragraph(anchor, doc._body)
+    else:
+        for paragraph in doc.paragraphs:
+            if header_text in paragraph.text:
+                target_paragraph = paragraph
+                break
 
     if target_paragraph is None:
         print(f"Header '{header_text}' not found in the document.")
-        return
+        return []
 
     target_paragraph.insert_paragraph_before()
 
-    # Add a table after the new paragraph
+    column_width = table_width // columns
+    image_width = image_width_for(columns, table_width)
+
+    tables = []
+    table = None
+    row_cells = None
+    rows_in_table = 0
+    last_element = target_paragraph._element
+
+    count = 0
+    for count, image in enumerate(images, start=1):
+        if isinstance(image, str):
+            image = ImageRecord(image)
+
+        column = (count - 1) % columns
+        if column == 0:
+            if table is not None and rows_per_table and rows_in_table >= rows_per_table:
+                separator = make_table_separator(page_break)
+                last_element.addnext(separator)
+                last_element = separator
+                table = None
+
+            if table is None:
+                table, row_template = new_image_table(doc, columns, column_width)
+                # Move the table to the specific location after the target paragraph
+                last_element.addnext(table._element)
+                last_element = table._element
+                tables.append(table)
+                tr = table._tbl.tr_lst[0]
+                rows_in_table = 0
+            else:
+                # Copy the pre-formatted empty row instead of formatting each cell again
+                tr = copy.deepcopy(row_template)
+                table._tbl.append(tr)
+
+            rows_in_table += 1
+            row_cells = tr.tc_lst
+
+        paragraph = _Cell(row_cells[column], table).paragraphs[0]
+        run = paragraph.add_run()
+        add_picture(run, image, width=image_width)
+
+    print(f"Added {count} images in {len(tables)} tables.")
+    return tables
+
+
+def image_width_for(columns, table_width=Inches(7.4)):
+    """Width of an image in an image table with `columns` columns."""
+    return table_width // columns - Inches(0.1)
+
+
+def new_image_table(doc, columns, column_width):
+    """Return a bordered, centered one-row table and a copy of its empty row."""
     # We can't directly control placement through doc.add_table, so we'll insert it programmatically
-    table = doc.add_table(rows=1, cols=2)
+    table = doc.add_table(rows=1, cols=columns)
 
     set_table_borders(table)
 
-     # Disable automatic table resizing
+    # Disable automatic table resizing
     table.autofit = False
 
     # Set table alignment to center
     table.alignment = WD_TABLE_ALIGNMENT.CENTER
 
+    set_cell_margins(table, left=72, right=72, top=72, bottom=0)
+
     # Set column widths
     for column in table.columns:
-        column.width = Inches(3.7)  # Set column width to 2 inches
-        for cell in column.cells:
-            cell.width = Inches(3.7)
-
-    # Move the table to the specific location after the target paragraph
-    # Using the XML elements for moving the table
-    target_paragraph._element.addnext(table._element)
-
-    # Add images to each cell in the table
-    for i, image_path in enumerate([image_path1, image_path2]):
-        cell = table.cell(0, i)
-        set_cell_margins(table, left=72, right=72, top=72, bottom=0)
-        paragraph = cell.paragraphs[0]
-        paragraph.alignment = WD_TABLE_ALIGNMENT.CENTER
-        run = paragraph.add_run()
-        run.add_picture(image_path, width=Inches(3.6))  # Adjust width as needed
+        column.width = column_width
+    for cell in table.rows[0].cells:
+        cell.width = column_width
+        cell.paragraphs[0].alignment = WD_TABLE_ALIGNMENT.CENTER
 
-    # Save the modified document
-    # doc.save('modified_document.docx')
-    print("Document modified successfully.")
+    # Keep each row of images on one page
+    tr = table._tbl.tr_lst[0]
+    tr.get_or_add_trPr().append(OxmlElement('w:cantSplit'))
 
+    return table, copy.deepcopy(tr)
 
-def replace_text_in_paragraph(paragraph, old_texts, new_texts):
-    for old_text, new_text in zip(old_texts, new_texts):
-        if old_text in paragraph.text:
-            paragraph.text = paragraph.text.replace(old_text, new_text)
 
-            run = paragraph.runs[0]
-            run.font.name = 'Calibri (Body)'
-            run.font.size = Pt(11)
+def make_table_separator(page_break):
+    # Adjacent tables would merge into one, so keep a paragraph between them
+    paragraph = OxmlElement('w:p')
+    if page_break:
+        run = make_run()
+        run.append(OxmlElement('w:br', attrs={qn('w:type'): 'page'}))
+        paragraph.append(run)
+    return paragraph
 
 
-def replace_text_in_table(table, old_texts, new_texts):
-    for row in table.rows:
-        for cell in row.cells:
-            for paragraph in cell.paragraphs:
-                replace_text_in_paragraph(paragraph, old_texts, new_texts)
+class PlaceholderReplacer:
+    """
+    Replace every placeholder of a document in a single scan per paragraph.
 
+    All keys are compiled into one alternation regex (longest key first), so
+    each paragraph is matched once no matter how many placeholders there are.
+    Only the text of the runs a match touches is rewritten, which keeps their
+    formatting, and placeholders split across several runs are still found.
+    """
 
-def add_captions_with_win32com(doc_path, images):
-    # Open Word application
-    word = win32.Dispatch('Word.Application')
-    word.Visible = False  # Set to True if you want to see Word while working
+    def __init__(self, replacements):
+        self.replacements = dict(replacements)
+        keys = sorted((key for key in self.replacements if key), key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(key) for key in keys)) if keys else None
+        self.count = 0
+
+    def replace_in_document(self, doc):
+        """Replace placeholders in the body, headers and footers, including nested tables."""
+        for element in document_story_elements(doc):
+            for p in element.iter(qn('w:p')):
+                self.replace_in_paragraph(p)
+        return self.count
+
+    def replace_in_paragraph(self, p):
+        if self.pattern is None:
+            return 0
+        t_elements = list(p.iter(qn('w:t')))
+        texts = [t.text or "" for t in t_elements]
+        matches = list(self.pattern.finditer("".join(texts)))
+        if not matches:
+            return 0
+
+        # Start offset of each w:t in the paragraph text
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text)
+
+        # Work from the last match back so earlier offsets stay valid
+        changed = set()
+        for match in reversed(matches):
+            start, end = match.span()
+            first = bisect.bisect_right(starts, start) - 1
+            last = bisect.bisect_right(starts, end - 1) - 1
+            new_text = self.replacements[match.group(0)]
+            if first == last:
+                text = texts[first]
+                texts[first] = text[:start - starts[first]] + new_text + text[end - starts[first]:]
+            else:
+                texts[first] = texts[first][:start - starts[first]] + new_text
+                for i in range(first + 1, last):
+                    texts[i] = ""
+                texts[last] = texts[last][end - starts[last]:]
+            changed.update(range(first, last + 1))
+
+        for i in changed:
+            t = t_elements[i]
+            t.text = texts[i]
+            if texts[i] != texts[i].strip():
+                t.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+
+        self.count += len(matches)
+        increment("placeholders replaced", len(matches))
+        return len(matches)
+
+
+def document_story_parts(doc):
+    """Yield the main document part and every header and footer part."""
+    yield doc.part
+    for rel in doc.part.rels.values():
+        if rel.reltype in (RT.HEADER, RT.FOOTER):
+            yield rel.target_part
+
+
+def document_story_elements(doc):
+    """Yield the root element of the body and of every header and footer part."""
+    yield doc.element.body
+    for part in document_story_parts(doc):
+        if part is not doc.part:
+            yield part.element
+
+
+@timed()
+def replace_placeholders(doc, custom_properties):
+    count = PlaceholderReplacer(custom_properties).replace_in_document(doc)
+    print(f"Replaced {count} placeholders")
+    return count
 
-    # Open the existing document
-    doc = word.Documents.Open(doc_path)
 
-    # Loop through all inline shapes (images) in the document
-    for i, inline_shape in enumerate(doc.InlineShapes):
-        # Get image file name
-        file_name = os.path.basename(images[i])
-        file_name = ". " + file_name
+def replace_text_in_paragraph(paragraph, old_texts, new_texts):
+    PlaceholderReplacer(zip(old_texts, new_texts)).replace_in_paragraph(paragraph._p)
 
-        # Select the inline shape (image)
-        inline_shape.Select()
 
-        # Insert a caption for the selected image (exclude custom title, only label + number)
-        word.Selection.InsertCaption(Label="Figure", Title=file_name, ExcludeLabel=False, Position=-1)
+@timed()
+def replace_text_in_table(table, old_texts, new_texts):
+    increment("tables scanned")
+    replacer = PlaceholderReplacer(zip(old_texts, new_texts))
+    for p in table._tbl.iter(qn('w:p')):
+        replacer.replace_in_paragraph(p)
 
-        # Move the selection to the end of the caption
-        word.Selection.MoveRight(Unit=2, Count=1, Extend=1)
 
-        # Delete any text after the caption label (if any text remains after "Figure X")
-        word.Selection.TypeBackspace()
+@timed()
+def add_captions(doc, images, tables, label="Figure"):
+    """
+    Add a "Figure N. caption" caption below every inline image in `tables`.
 
-    # Update all fields (important for cross-references)
-    doc.Fields.Update()
+    `tables` are the image tables added to the report and `images` the
+    ImageRecords (or paths) of their images, in order. Pictures elsewhere in
+    the document, such as a logo in the template, are left alone.
 
-    # Save and close the document
-    doc.Save()
-    doc.Close()
-    word.Quit()
+    Captions are written as SEQ fields with their result already filled in,
+    so the document opens with correct numbers without a field update. The
+    label and number of each caption are wrapped in a bookmark that the
+    bullet cross-references point to.
+    """
+    body = doc.element.body
+    bookmarks = BookmarkAllocator(doc)
+    caption_style = caption_style_id(doc)
+    tbls = {table._tbl for table in tables}
+
+    # Number the captions in document order, counting any existing ones
+    number = 0
+    i = 0
+    for element in list(body.iter(qn('w:drawing'), qn('w:instrText'), qn('w:fldSimple'))):
+        if element.tag == qn('w:drawing'):
+            if element.find(qn('wp:inline')) is None or i >= len(images) \
+                    or next(element.iterancestors(qn('w:tbl')), None) not in tbls:
+                continue
+            number += 1
+
+            # Use the image's caption, or its file name if it has none
+            image = images[i]
+            if isinstance(image, str):
+                image = ImageRecord(image)
+            file_name = ". " + caption_title(image)
+            i += 1
+
+            image_paragraph = next(element.iterancestors(qn('w:p')))
+            image_paragraph.addnext(
+                make_caption_paragraph(label, number, file_name, caption_style, image_paragraph, bookmarks)
+            )
+        elif is_seq_field(element, label):
+            number += 1
 
     print("Captions added successfully.")
 
 
+def caption_style_id(doc):
+    """
+    Return the id of the document's Caption style, adding it if the template lacks it.
+
+    Word creates its built-in Caption style the first time a caption is
+    inserted; without it the style is only latent, so it is added here
+    with Word's default formatting.
+    """
+    if 'Caption' not in doc.styles:
+        style = doc.styles.add_style('Caption', WD_STYLE_TYPE.PARAGRAPH)
+        style.base_style = doc.styles['Normal']
+        style.next_paragraph_style = doc.styles['Normal']
+        style.quick_style = True
+        style.font.italic = True
+        style.font.size = Pt(9)
+        style.font.color.rgb = RGBColor(0x44, 0x54, 0x6A)
+        style.paragraph_format.space_after = Pt(10)
+        print("Added the Caption style, which the template doesn't define")
+    return doc.styles['Caption'].style_id
+
+
+def caption_title(image):
+    # The image's caption, or its file name if it has none
+    return image.caption or os.path.basename(image.path)
+
+
+def is_seq_field(element, label):
+    if element.tag == qn('w:fldSimple'):
+        instruction = element.get(qn('w:instr'))
+    else:
+        instruction = element.text
+    return (instruction or "").split()[:2] == ["SEQ", label]
+
+
+def make_caption_paragraph(label, number, title, style_id, image_paragraph, bookmarks):
+    paragraph = OxmlElement('w:p')
+    pPr = paragraph.get_or_add_pPr()
+    pPr.style = style_id
+
+    # Keep the caption aligned with the image above it
+    if image_paragraph.pPr is not None and image_paragraph.pPr.jc_val is not None:
+        pPr.jc_val = image_paragraph.pPr.jc_val
+
+    bookmark_id, bookmark_name = bookmarks.next()
+    paragraph.append(make_bookmark_start(bookmark_id, bookmark_name))
+    paragraph.append(make_run(label + " "))
+    for run in make_field_runs(" SEQ %s \\* ARABIC " % label, str(number)):
+        paragraph.append(run)
+    paragraph.append(make_bookmark_end(bookmark_id))
+    paragraph.append(make_run(title))
+    return paragraph
+
+
+class BookmarkAllocator:
+    """Hand out bookmark ids and hidden "_Ref" names not yet used in the document."""
+
+    def __init__(self, doc):
+        body = doc.element.body
+        ids = [int(b.get(qn('w:id'))) for b in body.iter(qn('w:bookmarkStart')) if b.get(qn('w:id')).isdigit()]
+        self.names = set(b.get(qn('w:name')) for b in body.iter(qn('w:bookmarkStart')))
+        self.next_id = max(ids, default=-1) + 1
+        self.next_ref = 100000000
+
+    def next(self):
+        while "_Ref%d" % self.next_ref in self.names:
+            self.next_ref += 1
+        name = "_Ref%d" % self.next_ref
+        self.names.add(name)
+        bookmark_id = self.next_id
+        self.next_id += 1
+        self.next_ref += 1
+        return bookmark_id, name
+
+
+def make_bookmark_start(bookmark_id, name):
+    bookmark = OxmlElement('w:bookmarkStart')
+    bookmark.set(qn('w:id'), str(bookmark_id))
+    bookmark.set(qn('w:name'), name)
+    return bookmark
+
+
+def make_bookmark_end(bookmark_id):
+    bookmark = OxmlElement('w:bookmarkEnd')
+    bookmark.set(qn('w:id'), str(bookmark_id))
+    return bookmark
+
+
+def make_run(text=None, bold=False):
+    run = OxmlElement('w:r')
+    if bold:
+        rPr = run.get_or_add_rPr()
+        rPr._add_b()
+    if text is not None:
+        run.add_t(text)
+    return run
+
+
+def make_field_runs(instruction, result, bold=False):
+    """Return the runs of a complex field whose cached result is `result`."""
+    begin = make_run(bold=bold)
+    begin.append(OxmlElement('w:fldChar', attrs={qn('w:fldCharType'): 'begin'}))
+
+    instr = make_run(bold=bold)
+    instr_text = OxmlElement('w:instrText')
+    instr_text.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+    instr_text.text = instruction
+    instr.append(instr_text)
+
+    separate = make_run(bold=bold)
+    separate.append(OxmlElement('w:fldChar', attrs={qn('w:fldCharType'): 'separate'}))
+
+    end = make_run(bold=bold)
+    end.append(OxmlElement('w:fldChar', attrs={qn('w:fldCharType'): 'end'}))
+
+    return [begin, instr, separate, make_run(result, bold=bold), end]
+
+
 def set_table_borders(table):
     """
     Set the borders of the table to the specified color with a width of 2.25 pt.
@@ -163,6 +525,11 @@ def set_table_borders(table):
 def set_cell_margins(table, left=0, right=0, top=0, bottom=0):
     tc = table._element
     tblPr = tc.tblPr
+
+    # Replace any existing margins instead of adding a second w:tblCellMar
+    for existing in tblPr.findall(qn('w:tblCellMar')):
+        tblPr.remove(existing)
+
     tblCellMar = OxmlElement('w:tblCellMar')
     kwargs = {"left":left, "right":right, "top":top, "bottom":bottom}
     for m in ["left","right", "top", "bottom"]:
@@ -174,175 +541,174 @@ def set_cell_margins(table, left=0, right=0, top=0, bottom=0):
     tblPr.append(tblCellMar)
 
 
-def add_bullets_above_tables(output_doc_file_path):
-    #Open doc
-    doc = Document(output_doc_file_path)
-
-    # Loop through all tables in the document
-    tables = doc.tables
+@timed()
+def add_bullets_above_tables(doc, bullets=None, tables=None):
+    """
+    Insert bullet points above image tables.
 
-    for i, table in enumerate(tables):
+    `bullets` holds one list of bullet texts per table in `tables` (by default
+    every table except the first). Without `bullets`, each table gets the
+    "Bullet point 1" and "Bullet point 2" placeholders.
+    """
+    if tables is None:
         # Skip the first table
-        if i == 0:
-            continue
-
-        # Find the paragraph just before the table
-        paragraph_before_table = table._element.getprevious()
-
-        if paragraph_before_table is not None:
-            # Insert two bullet points above the table
-            bullet_1 = doc.add_paragraph("Bullet point 1", style='List Bullet 2')
-            bullet_2 = doc.add_paragraph("Bullet point 2", style='List Bullet 2')
-            
-            # Insert the bullet points before the table
-            paragraph_before_table.addnext(bullet_2._element)
-            bullet_2._element.addprevious(bullet_1._element)
-
-    # doc.save(output_doc_file_path)
-    print(f"Bullets added above all tables except the first")
-
+        tables = doc.tables[1:]
+    if bullets is None:
+        bullets = [["Bullet point 1", "Bullet point 2"]] * len(tables)
+    place_bullets(doc, bullets, tables, template_bullets=())
     return doc
 
 
-def append_cross_references_to_bullets(docx_path):
-    """Append cross-references to the beginning of each bullet point and make Figure 1 and Figure 2 bold."""
-    # Open Word application
-    word = win32.Dispatch('Word.Application')
-    word.Visible = False  # Set to True if you want to see Word while working
-
-    # Open the existing document
-    doc = word.Documents.Open(docx_path)
-
-    try:
-        # Get the cross-reference items for "Figure"
-        ref_items = doc.GetCrossReferenceItems("Figure")
-        
-        # Debug: Print available cross-reference items
-        print("Available cross-reference items for 'Figure':")
-        for idx, item in enumerate(ref_items):
-            print(f"{idx+1}: {item}")
-        
-        if len(ref_items) < 2:
-            print("Error: There are fewer than two figures to reference.")
-            doc.Close(False)
-            word.Quit()
-            return
-
-        # Set the figure references for bullet 1 and bullet 2
-        figure_1_ref = 1  # Reference to Figure 1
-        figure_2_ref = 2  # Reference to Figure 2
-
-        # Loop through the paragraphs to find bullet points and append cross-references
-        for para in doc.Paragraphs:
-            if para.Range.Text.strip() == "Bullet point 1":
-                # Move the cursor to the beginning of the paragraph and insert the cross-reference for Figure 1
-                word.Selection.SetRange(para.Range.Start, para.Range.Start)
-                word.Selection.InsertCrossReference(
-                    ReferenceType="Figure",
-                    ReferenceKind=3,  # 3 corresponds to wdOnlyLabelAndNumber (Figure X)
-                    ReferenceItem=figure_1_ref,
-                    InsertAsHyperlink=True,  # Optional: make it a hyperlink
-                    IncludePosition=False,
-                    SeparateNumbers=False,
-                    SeparatorString=" "
-                )
-
-                # Bold the inserted Figure 1 text
-                word.Selection.MoveLeft(Unit=1, Count=1, Extend=True)  # 1 = wdCharacter
-                word.Selection.Font.Bold = True
-
-                # Move cursor to the end of the bolded Figure 1 text
-                word.Selection.Collapse(Direction=0)
-
-                word.Selection.TypeText(" ")  # Add a space before the original text
-
-                word.Selection.Font.Bold = False
-
-                word.Selection.TypeText("shows ")  # Add a space before the original text
-
-                # Move the selection to the end of the caption
-                word.Selection.MoveRight(Unit=1, Count=14, Extend=1) #Bullet point 1
-
-                # Delete any text after the caption label (if any text remains after "Figure X")
-                word.Selection.TypeBackspace()
-
-                set_font_formatting(para, word)
-
-                set_paragraph_spacing(para, word)
-
-            elif para.Range.Text.strip() == "Bullet point 2":
-                # Move the cursor to the beginning of the paragraph and insert the cross-reference for Figure 2
-                word.Selection.SetRange(para.Range.Start, para.Range.Start)
-                word.Selection.InsertCrossReference(
-                    ReferenceType="Figure",
-                    ReferenceKind=3,  # 3 corresponds to wdOnlyLabelAndNumber (Figure X)
-                    ReferenceItem=figure_2_ref,
-                    InsertAsHyperlink=True,  # Optional: make it a hyperlink
-                    IncludePosition=False,
-                    SeparateNumbers=False,
-                    SeparatorString=" "
-                )
-
-                # Bold the inserted Figure 2 text
-                word.Selection.MoveLeft(Unit=1, Count=1, Extend=True)  # 1 = wdCharacter
-                word.Selection.Font.Bold = True
+@timed()
+def place_bullets(doc, bullets, tables, template_bullets=None, style='List Bullet 2'):
+    """
+    Insert bullets above image tables and remove the template bullets, in one pass.
 
-                # Move cursor to the end of the bolded Figure 2 text
-                word.Selection.Collapse(Direction=0)
+    `bullets` holds one list of bullet texts per table in `tables`. The
+    template bullets removed are the `template_bullets` elements when given,
+    otherwise the first three body paragraphs in TEMPLATE_BULLET_STYLES.
+    Styles are compared by id and tables are looked up by element, so the
+    walk over the body stays linear in the number of its children.
+    """
+    bullets_by_table = {table._element: texts for table, texts in zip(tables, bullets)}
+    style_id = doc.styles[style].style_id
+    if template_bullets is None:
+        remove = None
+        template_style_ids = style_ids(doc, TEMPLATE_BULLET_STYLES)
+    else:
+        remove = set(template_bullets)
+    removed = 0
+    tables_done = 0
+
+    # The children are listed up front so the inserted bullets are never visited
+    for child in list(doc.element.body.iterchildren()):
+        if child.tag == qn('w:p'):
+            if remove is not None:
+                if child not in remove:
+                    continue
+            elif removed >= 3 or child.style not in template_style_ids:
+                continue
+            child.getparent().remove(child)
+            removed += 1
+        elif child.tag == qn('w:tbl') and child in bullets_by_table:
+            # Insert the bullet points before the table, in order
+            for text in bullets_by_table[child]:
+                child.addprevious(make_bullet_paragraph(text, style_id))
+            tables_done += 1
+
+    if bullets_by_table:
+        print(f"Bullets added above {tables_done} tables")
+    if removed:
+        print(f"Removed {removed} template bullets")
+
+
+@timed()
+def add_cross_references_to_bullets(doc, label="Figure"):
+    """
+    Prepend a bold "Figure N" cross-reference to the bullets above image tables.
 
-                word.Selection.TypeText(" ")  # Add a space before the original text
+    The k-th "List Bullet 2" bullet directly above an image table refers to
+    the k-th figure in that table ("Bullet point k" always refers to figure
+    k and is replaced by "shows "). The reference is a hyperlinked REF field
+    to the caption bookmark, with its result pre-populated.
+    """
+    body = doc.element.body
+    bullet_2_style = doc.styles['List Bullet 2']
+    bullets = []
+    count = 0
 
-                word.Selection.Font.Bold = False
+    for child in list(body.iterchildren()):
+        if child.tag == qn('w:p'):
+            if child.style == bullet_2_style.style_id:
+                bullets.append(child)
+            else:
+                bullets = []
+        elif child.tag == qn('w:tbl'):
+            # Every body table is looked at once per build, here
+            increment("tables scanned")
+            figures = caption_bookmarks(child, label)
+            for k, paragraph in enumerate(bullets if figures else [], start=1):
+                text = "".join(t.text or "" for t in paragraph.iter(qn('w:t'))).strip()
+                match = re.fullmatch(r"Bullet point (\d+)", text)
+                if match:
+                    k = int(match.group(1))
+                    text = "shows "
+                if k > len(figures):
+                    print(f"Error: There is no {label} {k} in the table below bullet '{text}'.")
+                    continue
+                bookmark_name, reference_text = figures[k - 1]
+                insert_cross_reference(paragraph, bookmark_name, reference_text, text)
+                set_font_formatting(paragraph)
+                set_paragraph_spacing(paragraph)
+                count += 1
+            bullets = []
+
+    # Equivalent of turning off "Don't add space between paragraphs of the same style"
+    pPr = bullet_2_style.element.pPr
+    if pPr is not None:
+        for contextual_spacing in pPr.findall(qn('w:contextualSpacing')):
+            pPr.remove(contextual_spacing)
+
+    print(f"Cross-references appended to {count} bullets")
+
+
+def caption_bookmarks(table, label):
+    """Return (bookmark name, "Figure N") for each caption in `table`, in order."""
+    figures = []
+    for paragraph in table.iter(qn('w:p')):
+        bookmark = paragraph.find(qn('w:bookmarkStart'))
+        if bookmark is None or not bookmark.get(qn('w:name')).startswith("_Ref"):
+            continue
+        instr_texts = [t for t in paragraph.iter(qn('w:instrText')) if is_seq_field(t, label)]
+        if not instr_texts:
+            continue
+        number = "".join(t.text or "" for t in paragraph.iter(qn('w:t'))).split(".")[0]
+        figures.append((bookmark.get(qn('w:name')), number))
+    return figures
 
-                word.Selection.TypeText("shows ")  # Add a space before the original text
 
-                # Move the selection to the end of the caption
-                word.Selection.MoveRight(Unit=1, Count=14, Extend=1) #Bullet point 1
+def insert_cross_reference(paragraph, bookmark_name, reference_text, text):
+    # Rewrite the bullet as the reference followed by its text, keeping the paragraph properties
+    for child in list(paragraph):
+        if child.tag != qn('w:pPr'):
+            paragraph.remove(child)
 
-                # Delete any text after the caption label (if any text remains after "Figure X")
-                word.Selection.TypeBackspace()
+    for run in make_field_runs(" REF %s \\h " % bookmark_name, reference_text, bold=True):
+        paragraph.append(run)
+    paragraph.append(make_run(" " + text))
 
-                set_font_formatting(para, word)
 
-                set_paragraph_spacing(para, word)
+def set_font_formatting(paragraph):
+    """Set font formatting for the paragraph to Calibri (Body) 12."""
+    for run in paragraph.iter(qn('w:r')):
+        rPr = run.get_or_add_rPr()
+        rFonts = rPr.get_or_add_rFonts()
+        rFonts.set(qn('w:asciiTheme'), 'minorHAnsi')
+        rFonts.set(qn('w:hAnsiTheme'), 'minorHAnsi')
+        rPr.sz_val = Pt(12)
 
-        # Save the document with cross-references
-        doc.SaveAs(docx_path)
-        doc.Close()
-        word.Quit()
 
-        print(f"Cross-references appended and both Figure 1 and Figure 2 made bold, saved to {docx_path}")
+def set_paragraph_spacing(paragraph):
+    pPr = paragraph.get_or_add_pPr()
+    pPr.spacing_before = Pt(6)
+    pPr.spacing_after = Pt(6)
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        doc.Close(False)
-        word.Quit()
 
+def style_ids(doc, names):
+    """Return the ids of the styles called `names`, skipping those the document doesn't define."""
+    return set(doc.styles[name].style_id for name in names if name in doc.styles)
 
-def set_font_formatting(para, word):
-    """Set font formatting for the paragraph to Calibri 12."""
-    # Apply the font to the whole range of the paragraph
-    para.Range.Font.Name = 'Calibri (Body)'
-    para.Range.Font.Size = 12
 
-def set_paragraph_spacing(para, word):
-    word.Selection.SetRange(para.Range.Start, para.Range.End)
-    word.Selection.ParagraphFormat.SpaceBefore = 6
-    word.Selection.ParagraphFormat.SpaceAfter = 6
-    para.Style.NoSpaceBetweenParagraphsOfSameStyle = False
+def make_bullet_paragraph(text, style_id):
+    paragraph = OxmlElement('w:p')
+    paragraph.style = style_id
+    run = OxmlElement('w:r')
+    # Unlike w:t text, this turns tabs and line breaks into w:tab and w:br
+    run.text = text
+    paragraph.append(run)
+    return paragraph
 
 
-def delete_template_bullets(doc, output_doc_file_path):
-    count = 0
-    for para in doc.paragraphs:
-        if para.style.name in ["List Bullet", "List Bullet 2", "List Bullet 3"]:
-            if count >= 3:
-                break
-            # Remove the paragraph from the parent element (body)
-            p = para._element
-            p.getparent().remove(p)
-            # Clean up after removing
-            p._element = p = None
-            count += 1
-
-    doc.save(output_doc_file_path)
+@timed()
+def delete_template_bullets(doc):
+    place_bullets(doc, [], [])
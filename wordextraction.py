@@ -1,136 +1,401 @@
 import os
 import csv
-from docx import Document
-from docx.document import Document as _Document
-from docx.oxml.text.paragraph import CT_P
-from docx.oxml.table import CT_Tbl
-from docx.table import _Cell, Table
-from docx.text.paragraph import Paragraph
-
-def iter_block_items(parent):
-    if isinstance(parent, _Document):
-        parent_elm = parent.element.body
-    elif isinstance(parent, _Cell):
-        parent_elm = parent._tc
-    else:
-        raise ValueError("Parent must be a Document or _Cell instance")
-    for child in parent_elm.iterchildren():
-        if isinstance(child, CT_P):
-            yield Paragraph(child, parent)
-        elif isinstance(child, CT_Tbl):
-            yield Table(child, parent)
-
-def extract_and_save(docx_path, output_folder):
-    document = Document(docx_path)
-    
+from collections import namedtuple
+import ntpath
+import posixpath
+import zipfile
+import io
+import sys
+from lxml import etree
+from sinks import DirectorySink, ImageWriter
+from record_store import RecordStore
+from utils import file_hash
+from instrumentation import increment, instrumented_job, timed
+from docx.oxml.ns import qn
+from docx.opc.constants import CONTENT_TYPE as CT, NAMESPACE
+from docx.opc.part import PartFactory
+from docx.package import Package
+from docx.parts.document import DocumentPart
+
+# Main document part of a macro-enabled .docm
+WML_DOCUMENT_MACRO_MAIN = 'application/vnd.ms-word.document.macroEnabled.main+xml'
+
+# Load it like a regular .docx main part; vbaProject.bin is kept as an opaque part
+PartFactory.part_type_for.setdefault(WML_DOCUMENT_MACRO_MAIN, DocumentPart)
+
+
+def open_document(docx_path):
+    """
+    Open a .docx or .docm input document.
+
+    python-docx's Document() rejects the macro-enabled main part, so the
+    package is opened directly and any WordprocessingML main part accepted.
+    """
+    document_part = Package.open(docx_path).main_document_part
+    if document_part.content_type not in (CT.WML_DOCUMENT_MAIN, WML_DOCUMENT_MACRO_MAIN):
+        raise ValueError(f"file '{docx_path}' is not a Word file, content type is '{document_part.content_type}'")
+    return document_part.document
+
+
+# Records extracted from the input tables
+HeaderField = namedtuple('HeaderField', ['name', 'value'])
+TextBlock = namedtuple('TextBlock', ['content'])
+# `member` is the package part holding the image, `image_name` the name it is saved under
+PictureRow = namedtuple('PictureRow', ['index', 'description', 'caption', 'file_name', 'image_name', 'member'])
+
+
+class InputRecords:
+    __slots__ = ('header_fields', 'text_blocks', 'pictures')
+
+    def __init__(self):
+        self.header_fields = []
+        self.text_blocks = []
+        self.pictures = []
+
+
+class TableSchema:
+    """
+    Shape of one kind of input table.
+
+    A table matches when it has `columns` grid columns and, if `position` is
+    set, is that table in the document. The first `header_rows` rows are
+    labels and carry no data.
+    """
+    __slots__ = ('name', 'columns', 'position', 'header_rows')
+
+    def __init__(self, name, columns=None, position=None, header_rows=0):
+        self.name = name
+        self.columns = columns
+        self.position = position
+        self.header_rows = header_rows
+
+    def matches(self, table_number, num_columns):
+        if self.position is not None and self.position != table_number:
+            return False
+        return self.columns is None or self.columns == num_columns
+
+
+# Checked in order, the first match wins
+HEADER_FIELD_TABLE = TableSchema('header fields', position=0)
+FREE_TEXT_TABLE = TableSchema('free text', columns=1)
+PICTURE_TABLE = TableSchema('pictures', columns=4, header_rows=1)
+TABLE_SCHEMAS = (HEADER_FIELD_TABLE, FREE_TEXT_TABLE, PICTURE_TABLE)
+
+
+def classify_table(table_number, num_columns):
+    for schema in TABLE_SCHEMAS:
+        if schema.matches(table_number, num_columns):
+            return schema
+    return None
+
+
+class RecordExtractor:
+    """
+    Turn the top-level w:tbl elements of an input document into records.
+
+    Each table's grid is read once from the XML, and the text of every
+    cell is computed once even if the cell spans several grid columns.
+    `relationships` maps the document's relationship ids to image parts.
+    """
+
+    def __init__(self, relationships):
+        self.relationships = relationships
+        self.records = InputRecords()
+        self.table_number = 0
+        self.image_count = 1
+
+    def add_table(self, tbl):
+        """Add the records of one table and return its new PictureRows."""
+        increment("tables scanned")
+        grid = table_grid(tbl)
+        texts = {}
+        rows = [[texts[tc] if tc in texts else texts.setdefault(tc, cell_text(tc).strip()) for tc in row]
+                for row in grid]
+        num_columns = len(rows[0]) if rows else 0
+
+        schema = classify_table(self.table_number, num_columns)
+        pictures = []
+        if schema is HEADER_FIELD_TABLE:
+            # Columns 1 and 2, then columns 3 and 4, are name/value pairs
+            for row in rows:
+                if len(row) == 4:
+                    self.records.header_fields.append(HeaderField(row[0], row[1]))
+                    self.records.header_fields.append(HeaderField(row[2], row[3]))
+        elif schema is FREE_TEXT_TABLE:
+            for row in rows:
+                self.records.text_blocks.append(TextBlock(row[0]))
+        elif schema is PICTURE_TABLE:
+            for row, cells in zip(rows[schema.header_rows:], grid[schema.header_rows:]):
+                if len(row) != 4:
+                    continue
+                picture = self.picture_row(row, cells[3])
+                self.records.pictures.append(picture)
+                if picture.image_name:
+                    increment("pictures extracted")
+                    pictures.append(picture)
+        else:
+            # If the table doesn't match any known format, you can choose to log it or handle it differently
+            print(f"Unknown table format with {num_columns} columns at table number {self.table_number + 1}")
+
+        self.table_number += 1
+        return pictures
+
+    def picture_row(self, row, picture_cell):
+        index, description, caption = row[0], row[1], row[2]
+        for alt_text, embed in cell_drawings(picture_cell):
+            if not alt_text:
+                print(f"No alt-text found for image at index {index}")
+                continue
+            if embed not in self.relationships:
+                continue
+            # Extract the file name from the file path in alt-text
+            picture_filename = ntpath.basename(alt_text)
+            member = self.relationships[embed]
+
+            # Ensure the file name has the correct extension
+            file_name = picture_filename
+            image_extension = os.path.splitext(member)[1]
+            if not file_name.lower().endswith(image_extension.lower()):
+                file_name = os.path.splitext(file_name)[0] + image_extension
+            # Add a unique prefix to prevent overwriting files
+            image_name = f"{self.image_count:03d}_{file_name}"
+            self.image_count += 1
+            # Assume one image per cell
+            return PictureRow(index, description, caption, picture_filename, image_name, member)
+
+        return PictureRow(index, description, caption, "", "", "")
+
+
+@timed()
+def write_csvs(records, output_folder):
     os.makedirs(output_folder, exist_ok=True)
-    
+
     # Define CSV file paths
     table1_csv_path = os.path.join(output_folder, 'table1_data.csv')
     data_tables_csv_path = os.path.join(output_folder, 'data_tables.csv')
     picture_data_csv_path = os.path.join(output_folder, 'picture_data.csv')
-    
-    # Open CSV files
-    with open(table1_csv_path, 'w', newline='', encoding='utf-8') as table1_csvfile, \
-         open(data_tables_csv_path, 'w', newline='', encoding='utf-8') as data_tables_csvfile, \
-         open(picture_data_csv_path, 'w', newline='', encoding='utf-8') as picture_csvfile:
-        
-        table1_writer = csv.writer(table1_csvfile)
-        data_tables_writer = csv.writer(data_tables_csvfile)
-        picture_csv_writer = csv.writer(picture_csvfile)
-        
-        # Write headers for each CSV
-        table1_writer.writerow(['Field1', 'Field2'])
-        data_tables_writer.writerow(['Content'])
-        picture_csv_writer.writerow(['Index', 'Description', 'Caption', 'Picture File Name'])
-        
-        image_count = 1
-        table_number = 0
-        
-        for block in iter_block_items(document):
-            if isinstance(block, Table):
-                # Determine the number of columns in the table
-                first_row = block.rows[0]
-                num_columns = len(first_row.cells)
-                
-                if table_number == 0:
-                    # Process the first table (4 columns)
-                    for row in block.rows:
-                        cells = row.cells
-                        if len(cells) == 4:
-                            # Write columns 1 and 2 into Field1 and Field2
-                            field1 = cells[0].text.strip()
-                            field2 = cells[1].text.strip()
-                            table1_writer.writerow([field1, field2])
-                            # Write columns 3 and 4 into Field1 and Field2
-                            field1 = cells[2].text.strip()
-                            field2 = cells[3].text.strip()
-                            table1_writer.writerow([field1, field2])
-                elif num_columns == 1:
-                    # Process one-column tables (like Table 2)
-                    for row in block.rows:
-                        cell_text = row.cells[0].text.strip()
-                        data_tables_writer.writerow([cell_text])
-                elif num_columns == 4:
-                    # Process picture tables
-                    for row in block.rows[1:]:  # Skip header row
-                        cells = row.cells
-                        if len(cells) == 4:
-                            index = cells[0].text.strip()
-                            description = cells[1].text.strip()
-                            caption = cells[2].text.strip()
-                            
-                            # Handle picture
-                            picture_cell = cells[3]
-                            picture_filename = ""
-                            for paragraph in picture_cell.paragraphs:
-                                for run in paragraph.runs:
-                                    # Check if the run contains a drawing (image)
-                                    if 'Drawing' in run._element.xml:
-                                        # Extract the alt-text (description) of the image
-                                        docPr_elements = run._element.xpath('.//wp:docPr')
-                                        if docPr_elements:
-                                            alt_text = docPr_elements[0].get('descr')
-                                            if alt_text:
-                                                # Extract the file name from the file path in alt-text
-                                                file_name = os.path.basename(alt_text)
-                                                picture_filename = file_name
-                                                # Get the image part
-                                                blip = run._element.xpath('.//a:blip')[0]
-                                                embed = blip.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                                                image_part = run.part.related_parts[embed]
-                                                
-                                                # Save image using file name
-                                                image_extension = os.path.splitext(image_part.partname)[1]
-                                                # Ensure the file name has the correct extension
-                                                if not file_name.lower().endswith(image_extension.lower()):
-                                                    file_name = os.path.splitext(file_name)[0] + image_extension
-                                                # Add a unique prefix to prevent overwriting files
-                                                image_name = f"{image_count:03d}_{file_name}"
-                                                image_path = os.path.join(output_folder, image_name)
-                                                with open(image_path, 'wb') as f:
-                                                    f.write(image_part.blob)
-                                                
-                                                image_count += 1
-                                                break  # Assume one image per cell
-                                        else:
-                                            print(f"No alt-text found for image at index {index}")
-                                if picture_filename:
-                                    break
-                            
-                            # Write to picture CSV
-                            picture_csv_writer.writerow([index, description, caption, picture_filename])
-                else:
-                    # If the table doesn't match any known format, you can choose to log it or handle it differently
-                    print(f"Unknown table format with {num_columns} columns at table number {table_number + 1}")
-                table_number += 1
-        
+
+    with open(table1_csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Field1', 'Field2'])
+        writer.writerows(records.header_fields)
+
+    with open(data_tables_csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Content'])
+        writer.writerows(records.text_blocks)
+
+    with open(picture_data_csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Index', 'Description', 'Caption', 'Picture File Name'])
+        writer.writerows(picture[:4] for picture in records.pictures)
+
     print(f"Data from the first table extracted and saved to {table1_csv_path}")
     print(f"Additional data extracted and saved to {data_tables_csv_path}")
     print(f"Picture data extracted and saved to {picture_data_csv_path}")
-    print(f"Images saved in {output_folder}")
 
-# Usage NEEDS DOCM TO BE SAVED AS DOCX
-docx_path = r'C:\Users\dfernandez\OneDrive - Maverick Applied Science\Desktop\ReportInputsTemplate.docx'
-output_folder = 'image_temp'
-extract_and_save(docx_path, output_folder)
+
+@timed()
+def extract_and_save(docx_path, output_folder, streaming=True, sink=None, image_workers=4, db_path=None):
+    """
+    Extract the input tables to CSV files in `output_folder` and the pictures
+    to `sink` (by default the same folder). Pictures are written by a pool of
+    `image_workers` threads while the document is still being read.
+
+    The document is streamed and each picture copied straight from the zip;
+    with `streaming=False` it is loaded with python-docx instead, which holds
+    every image part in memory.
+
+    With `db_path`, the records are also stored in that SQLite database and
+    the pictures in its content-addressed image folder (see RecordStore).
+
+    Returns the extracted InputRecords.
+    """
+    if sink is None:
+        sink = DirectorySink(output_folder)
+
+    records = extract_records(docx_path, sink, streaming, image_workers, db_path)
+
+    write_csvs(records, output_folder)
+    print(f"Images saved in {sink}")
+    return records
+
+
+@timed()
+def extract_records(docx_path, sink, streaming=True, image_workers=4, db_path=None):
+    """
+    Extract the input tables to InputRecords and the pictures to `sink`.
+
+    With `db_path`, the pictures are also hashed and kept in the RecordStore
+    at `db_path` as they are written, and the records stored there in one
+    transaction once the document has been read.
+    """
+    if db_path is None:
+        return _extract_records(docx_path, sink, streaming, image_workers)
+
+    with RecordStore(db_path) as store:
+        storing_sink = store.sink(sink)
+        records = _extract_records(docx_path, storing_sink, streaming, image_workers)
+        store.add_document(docx_path, file_hash(docx_path), records, storing_sink.images)
+    return records
+
+
+def _extract_records(docx_path, sink, streaming, image_workers):
+    if streaming:
+        return extract_records_streaming(docx_path, sink, image_workers)
+
+    document = open_document(docx_path)
+
+    # Image parts by relationship id
+    parts = {}
+    for rId, rel in document.part.rels.items():
+        if not rel.is_external:
+            parts[rId] = rel.target_part
+    extractor = RecordExtractor({rId: part.partname.lstrip('/') for rId, part in parts.items()})
+    parts = {part.partname.lstrip('/'): part for part in parts.values()}
+
+    with ImageWriter(sink, workers=image_workers) as image_writer:
+        for tbl in document.element.body.iterchildren(qn('w:tbl')):
+            for picture in extractor.add_table(tbl):
+                blob = parts[picture.member].blob
+                image_writer.submit(picture.image_name, lambda blob=blob: io.BytesIO(blob), len(blob))
+
+    return extractor.records
+
+
+def main_document_name(package):
+    """Return the zip member name of the main document part (.docx or .docm)."""
+    root = etree.fromstring(package.read('_rels/.rels'))
+    for rel in root.iterchildren('{%s}Relationship' % NAMESPACE.OPC_RELATIONSHIPS):
+        if rel.get('Type').endswith('/officeDocument'):
+            return rel.get('Target').lstrip('/')
+    raise ValueError("No main document part found in the package")
+
+
+def read_relationships(package, part_name):
+    """Map relationship ids of `part_name` to the zip member names they target."""
+    folder, name = posixpath.split(part_name)
+    rels_name = posixpath.join(folder, '_rels', name + '.rels')
+    relationships = {}
+    if rels_name not in package.namelist():
+        return relationships
+    root = etree.fromstring(package.read(rels_name))
+    for rel in root.iterchildren('{%s}Relationship' % NAMESPACE.OPC_RELATIONSHIPS):
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target')
+        if target.startswith('/'):
+            member = target.lstrip('/')
+        else:
+            member = posixpath.normpath(posixpath.join(folder, target))
+        relationships[rel.get('Id')] = member
+    return relationships
+
+
+def paragraph_text(p):
+    parts = []
+    for element in p.iter(qn('w:t'), qn('w:tab'), qn('w:br'), qn('w:cr')):
+        if element.tag == qn('w:t'):
+            parts.append(element.text or '')
+        elif element.tag == qn('w:tab'):
+            parts.append('\t')
+        else:
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def cell_text(tc):
+    return '\n'.join(paragraph_text(p) for p in tc.iterchildren(qn('w:p')))
+
+
+def table_grid(tbl):
+    """
+    Return the rows of a w:tbl as lists of w:tc, one entry per grid column.
+
+    Like python-docx's row.cells, a cell spanning several grid columns is
+    repeated, and a vertically merged continuation cell is replaced by the
+    cell it continues.
+    """
+    rows = []
+    for tr in tbl.iterchildren(qn('w:tr')):
+        row = []
+        for tc in tr.iterchildren(qn('w:tc')):
+            tcPr = tc.find(qn('w:tcPr'))
+            span = 1
+            merge = None
+            if tcPr is not None:
+                grid_span = tcPr.find(qn('w:gridSpan'))
+                if grid_span is not None:
+                    span = int(grid_span.get(qn('w:val')))
+                v_merge = tcPr.find(qn('w:vMerge'))
+                if v_merge is not None:
+                    merge = v_merge.get(qn('w:val'), 'continue')
+            column = len(row)
+            if merge == 'continue' and rows and column < len(rows[-1]):
+                tc = rows[-1][column]
+            row.extend([tc] * span)
+        rows.append(row)
+    return rows
+
+
+def cell_drawings(tc):
+    """Yield (alt text, blip rId) for each drawing in a cell, without serializing it."""
+    for drawing in tc.iter(qn('w:drawing')):
+        doc_pr = next(drawing.iter(qn('wp:docPr')), None)
+        blip = next(drawing.iter(qn('a:blip')), None)
+        alt_text = doc_pr.get('descr') if doc_pr is not None else None
+        embed = blip.get(qn('r:embed')) if blip is not None else None
+        yield alt_text, embed
+
+
+def iter_body_tables(xml_file):
+    """
+    Yield each w:tbl that is a direct child of w:body, once it is complete.
+
+    Tables nested in other tables, content controls (w:sdt) or text boxes
+    are skipped, as they are by the python-docx mode. Body children are
+    cleared as soon as they have been handled so memory use does not grow
+    with the size of the document.
+    """
+    body_tag = qn('w:body')
+    for _, element in etree.iterparse(xml_file, events=('end',), tag=(qn('w:tbl'), qn('w:p'), qn('w:sdt'))):
+        parent = element.getparent()
+        if parent is None or parent.tag != body_tag:
+            # Handled with the body child it belongs to
+            continue
+        if element.tag == qn('w:tbl'):
+            yield element
+
+        # Drop the handled element and everything before it in the body
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def extract_records_streaming(docx_path, sink, image_workers=4):
+    """
+    Same as extract_records, streaming word/document.xml instead of loading
+    the whole document. Images are copied straight from the zip.
+    """
+    with zipfile.ZipFile(docx_path) as package, \
+         ImageWriter(sink, workers=image_workers) as image_writer:
+
+        document_name = main_document_name(package)
+        extractor = RecordExtractor(read_relationships(package, document_name))
+
+        with package.open(document_name) as xml_file:
+            for tbl in iter_body_tables(xml_file):
+                for picture in extractor.add_table(tbl):
+                    image_writer.submit(picture.image_name, lambda member=picture.member: package.open(member),
+                                        package.getinfo(picture.member).file_size)
+
+    return extractor.records
+
+
+if __name__ == "__main__":
+    # Usage: python wordextraction.py [ReportInputsTemplate.docm or .docx] [output folder] [record database]
+    docx_path = sys.argv[1] if len(sys.argv) > 1 else 'ReportInputsTemplate.docm'
+    output_folder = sys.argv[2] if len(sys.argv) > 2 else 'image_temp'
+    db_path = sys.argv[3] if len(sys.argv) > 3 else None
+    with instrumented_job(os.path.basename(docx_path)):
+        extract_and_save(docx_path, output_folder, db_path=db_path)